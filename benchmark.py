@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+
+# Benchmark LED cube patterns
+# Released under the terms of the GNU General Public License version 3
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import numpy
+import cubehelper
+import memcube
+import patternloader
+import scheduler
+import serialcube
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+FIELDS = ['pattern', 'backend', 'ticks', 'ticks_per_sec', 'tick_p50_ms',
+          'tick_p90_ms', 'tick_p99_ms', 'tick_max_ms', 'set_pixel_per_frame',
+          'set_frame_per_frame', 'bytes_per_frame', 'peak_kb']
+
+class CountingCube(object):
+    """Forwards to a real cube, counting the drawing calls made by a pattern"""
+    def __init__(self, cube):
+        self.cube = cube
+        self.set_pixel_calls = 0
+        self.set_frame_calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.cube, name)
+
+    def set_pixel(self, xyz, rgb):
+        self.set_pixel_calls += 1
+        self.cube.set_pixel(xyz, rgb)
+
+    def set_frame(self, frame):
+        self.set_frame_calls += 1
+        self.cube.set_frame(frame)
+
+class CountingWriter(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.count = 0
+
+    def write(self, b):
+        self.count += len(b)
+        self.writer.write(b)
+
+    def close(self):
+        self.writer.close()
+
+def make_cube(backend, size):
+    cube_args = argparse.Namespace(size=size, port=None, queue=0)
+    if backend == 'mem':
+        c = memcube.Cube(cube_args)
+    else:
+        cube_args.port = '@' + os.devnull
+        c = serialcube.Cube(cube_args)
+        c.ser = CountingWriter(c.ser)
+    c.plasma = cubehelper.plasma_palette(c.color)
+    return c
+
+def run_ticks(pattern, cube, ticks):
+    """Run a pattern unthrottled, returning the time taken by each frame"""
+    pattern.init()
+    db = getattr(pattern, 'double_buffer', False)
+    if db:
+        cube.clear()
+        cube.swap()
+    else:
+        cube.single_buffer()
+        cube.clear()
+    times = numpy.zeros(ticks)
+    for n in range(0, ticks):
+        start = scheduler.monotonic()
+        try:
+            pattern.tick()
+        except StopIteration:
+            pass
+        cube.render()
+        if db:
+            cube.swap()
+        times[n] = scheduler.monotonic() - start
+    return times
+
+def bench_pattern(registry, name, arg, backend, args):
+    c = make_cube(backend, args.size)
+    counter = CountingCube(c)
+    pattern = registry.load(name, counter, arg)
+    if pattern is None:
+        return None
+    random.seed(args.seed)
+    try:
+        times = run_ticks(pattern, counter, args.ticks)
+    except StopIteration:
+        print("Pattern '%s' did not start" % name)
+        return None
+    except Exception as e:
+        print(e)
+        print("Pattern '%s' failed" % name)
+        return None
+    ticks = args.ticks
+    result = {
+        'pattern': name,
+        'backend': backend,
+        'ticks': ticks,
+        'ticks_per_sec': ticks / max(times.sum(), 1e-9),
+        'tick_p50_ms': numpy.percentile(times, 50) * 1000.0,
+        'tick_p90_ms': numpy.percentile(times, 90) * 1000.0,
+        'tick_p99_ms': numpy.percentile(times, 99) * 1000.0,
+        'tick_max_ms': times.max() * 1000.0,
+        'set_pixel_per_frame': counter.set_pixel_calls / float(ticks),
+        'set_frame_per_frame': counter.set_frame_calls / float(ticks),
+        'bytes_per_frame': None,
+        'peak_kb': None,
+    }
+    if backend == 'serial':
+        result['bytes_per_frame'] = c.ser.count / float(ticks)
+    elif tracemalloc is not None:
+        # Tracing slows everything down, so measure memory in a separate run
+        random.seed(args.seed)
+        tracemalloc.start()
+        run_ticks(pattern, counter, min(ticks, args.memory_ticks))
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    c.close()
+    return result
+
+def fmt(value, spec):
+    if value is None:
+        return '-'
+    return spec % value
+
+def print_table(results):
+    print("%-14s %-7s %10s %9s %9s %9s %9s %9s %9s" % ('pattern', 'backend',
+        'ticks/s', 'p50 ms', 'p90 ms', 'p99 ms', 'pix/frm', 'B/frm', 'peak KB'))
+    for r in results:
+        print("%-14s %-7s %10.1f %9.3f %9.3f %9.3f %9s %9s %9s" % (r['pattern'],
+            r['backend'], r['ticks_per_sec'], r['tick_p50_ms'], r['tick_p90_ms'],
+            r['tick_p99_ms'], fmt(r['set_pixel_per_frame'], '%.1f'),
+            fmt(r['bytes_per_frame'], '%.1f'), fmt(r['peak_kb'], '%.1f')))
+
+def open_output(name):
+    if name == '-':
+        return sys.stdout
+    return open(name, 'w')
+
+def main():
+    ap = argparse.ArgumentParser(description="LED cube pattern benchmark")
+    ap.add_argument('-s', '--size', type=int, default=8,
+            help="Cube size")
+    ap.add_argument('-p', '--pattern', type=str, action='append',
+            help="Patterns to run (default all)")
+    ap.add_argument('-t', '--ticks', type=int, default=200,
+            help="Number of ticks to run each pattern for")
+    ap.add_argument('-b', '--backend', type=str, action='append',
+            choices=['mem', 'serial'],
+            help="Backends to run against (default both)")
+    ap.add_argument('--memory-ticks', type=int, default=20,
+            help="Number of ticks to trace memory use over")
+    ap.add_argument('--seed', type=int, default=0,
+            help="Random seed, so runs are comparable")
+    ap.add_argument('--json', type=str,
+            help="Write results as JSON to this file ('-' for stdout)")
+    ap.add_argument('--csv', type=str,
+            help="Write results as CSV to this file ('-' for stdout)")
+    args = ap.parse_args()
+
+    registry = patternloader.PatternRegistry()
+    if args.pattern is None:
+        names = registry.names()
+    else:
+        names = ','.join(args.pattern).split(',')
+    backends = args.backend or ['mem', 'serial']
+    results = []
+    for name in names:
+        if ':' in name:
+            (name, arg) = name.split(':', 1)
+        else:
+            arg = None
+        for backend in backends:
+            if backend == 'serial' and args.size not in (4, 8):
+                continue
+            r = bench_pattern(registry, name, arg, backend, args)
+            if r is not None:
+                results.append(r)
+    print_table(results)
+    if args.json is not None:
+        f = open_output(args.json)
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+    if args.csv is not None:
+        f = open_output(args.csv)
+        w = csv.DictWriter(f, FIELDS)
+        w.writeheader()
+        w.writerows(results)
+
+if __name__ == '__main__':
+    main()
@@ -5,56 +5,11 @@
 # Released under the terms of the GNU General Public License version 3
 
 import argparse
-import itertools
-import pkgutil
 import time
 import signal
 import cubehelper
-import random
-
-def load_patterns(cube, match):
-    patterns = {}
-    arglist = {}
-    if match is None:
-        namelist = None
-    else:
-        namelist = []
-        for name in match:
-            if ':' in name:
-                (name, arg) = name.split(':', 1)
-            else:
-                arg = None
-            namelist.append(name)
-            arglist[name] = arg
-    for (finder, name, ispkg) in pkgutil.walk_packages(["patterns"]):
-        if match is not None and name not in arglist:
-            continue
-        print("Loading pattern module '%s'" % name)
-        try:
-            loader = finder.find_module(name)
-            mod = loader.load_module(name)
-            constructor = mod.Pattern
-        except Exception as e:
-            print(e)
-            print("Failed to load pattern '%s'" % name)
-            constructor = None
-        if constructor is not None:
-            pobj = constructor()
-            pobj.name = name
-            pobj.cube = cube
-            pobj.arg = arglist.get(name)
-            patterns[name] = pobj
-    if len(patterns) == 0:
-        raise Exception("No patterns found")
-    if match is None:
-        ordered = list(patterns.values())
-        random.shuffle(ordered)
-    else:
-        ordered = map(lambda x: patterns[x], namelist)
-    if args.noloop:
-        return iter(ordered)
-    else:
-        return itertools.cycle(ordered)
+import patternloader
+import scheduler
 
 # Returns true to quit
 def run_pattern(cube, pattern):
@@ -64,10 +19,10 @@ def run_pattern(cube, pattern):
             db = pattern.double_buffer
         except:
             db = False
-        now = time.time()
-        next_tick = now + interval
+        sched = scheduler.FrameScheduler(interval, args.catchup,
+                getattr(cube, 'idle', time.sleep))
+        now = sched.now()
         sec_tick = now + 1.0
-        frames = 0
         if args.interval > 0:
             partial = now + args.interval * 0.5
             expires = now + args.interval
@@ -75,6 +30,7 @@ def run_pattern(cube, pattern):
             partial = None
             expires = None
         print("Running pattern %s" % pattern.name)
+        cube.pattern_name = pattern.name
         if db:
             cube.clear()
             cube.swap()
@@ -93,18 +49,17 @@ def run_pattern(cube, pattern):
             cube.render()
             if db:
                 cube.swap()
-            now = time.time()
+            now = sched.now()
             if expires is not None and now > expires:
                 raise StopIteration
-            if next_tick > now:
-                time.sleep(next_tick - now)
-            next_tick += interval
-            frames += 1
+            sched.wait()
             if now >= sec_tick:
                 if debug_frames:
-                    print("%d/%d" % (frames, int(1.0/interval)))
+                    print("%d/%d late %d dropped %d max %.1fms" % (sched.frames,
+                        int(1.0/interval), sched.late, sched.dropped,
+                        sched.max_lateness * 1000.0))
                 sec_tick += 1.0
-                frames = 0
+                sched.reset_stats()
     except StopIteration:
         return
 
@@ -112,8 +67,8 @@ def sigterm_handler(_signo, _stack_frame):
     raise KeyboardInterrupt
 
 ap = argparse.ArgumentParser(description="LED cube demo program")
-ap.add_argument('-P', '--port', type=str,
-        help="Serial port")
+ap.add_argument('-P', '--port', type=str, action='append',
+        help="Serial port (repeat to drive several cubes as one)")
 ap.add_argument('-s', '--size', type=int, default=8,
         help="Cube size")
 ap.add_argument('-p', '--pattern', type=str, action='append',
@@ -124,20 +79,57 @@ ap.add_argument('-f', '--frames', action='store_true', default=False,
         help="Display framerate")
 ap.add_argument('-n', '--noloop', action='store_true', default=False,
 	help="Run selected pattern(s) only once, don't loop through them")
+ap.add_argument('--catchup', action='store_true', default=False,
+        help="Run late frames back to back rather than skipping them")
+ap.add_argument('--orbit', type=float, default=0.0,
+        help="Seconds per camera orbit in the OpenGL simulator")
+ap.add_argument('--display-rate', type=float, default=30.0,
+        help="OpenGL simulator redraw rate between pattern frames")
+ap.add_argument('-r', '--record', type=str,
+        help="Record the displayed frames to a file")
+ap.add_argument('--record-compression', type=str, default='delta',
+        choices=['raw', 'zlib', 'delta'],
+        help="Compression for recorded frames (raw files can be memory mapped)")
+ap.add_argument('--preroll', type=int, default=0,
+        help="Run patterns in worker processes, up to this many frames ahead")
+ap.add_argument('--layout', type=str, default='tile', choices=['tile', 'mirror'],
+        help="How to arrange several cubes: tiled into a larger cube, or mirrored")
+ap.add_argument('-q', '--queue', type=int, default=0,
+        help="Queue up to this many frames for a background output thread")
+ap.add_argument('--drop', action='store_true', default=False,
+        help="Drop queued frames rather than wait when the output queue is full")
+ap.add_argument('-l', '--list', action='store_true', default=False,
+        help="List the available patterns")
 args = ap.parse_args()
 
+if args.list:
+    registry = patternloader.PatternRegistry()
+    for name in registry.names():
+        print("%-16s %s" % (name, registry.describe(name)))
+    exit(0)
+
 debug_frames = args.frames
+ports = args.port
+if ports is not None:
+    args.port = ports[0]
 if args.port is None:
     import glcube
     c = glcube.Cube(args)
+elif len(ports) > 1:
+    import serialcube
+    c = serialcube.MultiCube(args, ports)
+elif args.port.split(':')[0] in ('null', 'mem'):
+    import memcube
+    c = memcube.Cube(args)
 else:
     import serialcube
     c = serialcube.Cube(args)
 
-if c.color:
-    c.plasma = cubehelper.color_plasma
-else:
-    c.plasma = cubehelper.mono_plasma
+if args.record is not None:
+    import framefile
+    c = framefile.Recorder(c, args.record, args.record_compression)
+
+c.plasma = cubehelper.plasma_palette(c.color)
 
 if args.pattern is None:
     pattern_list = None
@@ -159,12 +151,18 @@ except:
 
 signal.signal(signal.SIGTERM, sigterm_handler)
 
-patterns = load_patterns(c, pattern_list)
+patterns = patternloader.load_patterns(c, pattern_list, args.noloop)
+if args.preroll > 0:
+    import preroll
+    patterns = preroll.prerolled(patterns, c, args.preroll)
 try:
     for p in patterns:
         run_pattern(c, p)
 except KeyboardInterrupt:
     pass
-c.single_buffer()
-c.clear()
-c.render()
+finally:
+    # Also on an error, so the cube is blanked and a recording is finished
+    c.single_buffer()
+    c.clear()
+    c.render()
+    c.close()
@@ -1,6 +1,7 @@
 import random
 import numbers
 import math
+import numpy
 
 def line(p0, p1):
     d = [abs(p0[i] - p1[i]) for i in range(0, 3)]
@@ -78,36 +79,178 @@ def mono_plasma(val):
         val = 2.0 - val
     return (val, val, val)
 
+# Exact type checks are much cheaper than isinstance with the numbers
+# ABCs, so the common cases (tuples of Python ints or floats) go first.
+
+def is_int(v):
+    t = type(v)
+    if t is int:
+        return True
+    if t is float:
+        return False
+    return isinstance(v, numbers.Integral)
+
+PALETTE_SIZE = 1024
+
+class Palette(object):
+    """A color function of a value in [0, 1), sampled into a lookup table.
+
+    Values wrap around, as with color_plasma.  Call it with a scalar to get
+    a float color tuple, or with an array of values to get an array of
+    colors with a trailing RGB axis.  to_int does the same for uint8 colors."""
+    def __init__(self, fn, size=PALETTE_SIZE):
+        self.size = size
+        self.lut = numpy.array([fn(n / float(size)) for n in range(size)], float)
+        self.lut_int = array_to_int(self.lut)
+        # Scalar lookups return plain tuples, which the drivers take as they are
+        self.colors = [tuple(c) for c in self.lut.tolist()]
+        self.int_colors = [tuple(c) for c in self.lut_int.tolist()]
+
+    def index(self, val):
+        """Return the table index for each value"""
+        return numpy.floor(numpy.asarray(val) * self.size + 0.5).astype(numpy.intp) % self.size
+
+    def __call__(self, val):
+        if type(val) is float or type(val) is int:
+            return self.colors[int(math.floor(val * self.size + 0.5)) % self.size]
+        n = self.index(val)
+        if n.ndim == 0:
+            return self.colors[n]
+        return self.lut[n]
+
+    def to_int(self, val):
+        if type(val) is float or type(val) is int:
+            return self.int_colors[int(math.floor(val * self.size + 0.5)) % self.size]
+        n = self.index(val)
+        if n.ndim == 0:
+            return self.int_colors[n]
+        return self.lut_int[n]
+
+def plasma_palette(color):
+    """The palette cube.plasma should use, for a color or monochrome cube"""
+    if color:
+        return Palette(color_plasma)
+    return Palette(mono_plasma)
+
 def mix_color(color0, color1, level):
-    f0 = color_to_float(color0)
-    f1 = color_to_float(color1)
-    return tuple([f1[n] * level + f0[n] * (1.0 - level) for n in range(0, 3)])
+    (r0, g0, b0) = color_to_float(color0)
+    (r1, g1, b1) = color_to_float(color1)
+    l0 = 1.0 - level
+    return (r1 * level + r0 * l0, g1 * level + g0 * l0, b1 * level + b0 * l0)
 
 def color_to_hex(color):
-    if isinstance(color, numbers.Integral):
+    if is_int(color):
         return color
     (r, g, b) = color_to_int(color)
     return (r << 16) | (g << 8) | b
 
 def color_to_int(color):
-    if isinstance(color, numbers.Integral):
+    if is_int(color):
         return (color >> 16, (color >> 8) & 0xff, color & 0xff)
     (r, g, b) = color
-    if not isinstance(r, numbers.Integral):
+    if not is_int(r):
         r = int(r * 256.0 - 0.5)
         g = int(g * 256.0 - 0.5)
         b = int(b * 256.0 - 0.5)
     return (r, g, b)
 
 def color_to_float(color):
-    if isinstance(color, numbers.Integral):
+    if is_int(color):
         r = color >> 16
         g = (color >> 8) & 0xff
         b = color & 0xff
     else:
         (r, g, b) = color
-    if isinstance(r, numbers.Integral):
+    if is_int(r):
         r = (r + 0.5) / 256.0
         g = (g + 0.5) / 256.0
         b = (b + 0.5) / 256.0
     return (r, g, b)
+
+# For set_pixel, which is called once per voxel by many patterns: a tuple
+# that is already in the wanted form is passed through untouched.
+
+def fast_color_to_int(color):
+    if type(color) is tuple and type(color[0]) is int:
+        return color
+    return color_to_int(color)
+
+def fast_color_to_float(color):
+    if type(color) is tuple and type(color[0]) is float:
+        return color
+    return color_to_float(color)
+
+# The array versions take colors along the last axis, so (N, 3) or
+# (size, size, size, 3), and convert them all in one go.  A 0-d integer
+# array is a packed 0xRRGGBB color, as with the single color functions.
+
+def array_from_hex(a):
+    """Unpack an array of 0xRRGGBB colors into a uint8 array with a trailing RGB axis."""
+    a = numpy.asarray(a)
+    out = numpy.empty(a.shape + (3,), numpy.uint8)
+    out[..., 0] = (a >> 16) & 0xff
+    out[..., 1] = (a >> 8) & 0xff
+    out[..., 2] = a & 0xff
+    return out
+
+def array_to_hex(a):
+    """Pack an array of colors (last axis RGB) into 0xRRGGBB integers, as color_to_hex does for a single color."""
+    a = array_to_int(a).astype(numpy.uint32)
+    return (a[..., 0] << 16) | (a[..., 1] << 8) | a[..., 2]
+
+def array_to_int(a):
+    """Convert an array of colors (last axis RGB) to uint8, as color_to_int does for a single color."""
+    a = numpy.asarray(a)
+    if a.dtype == numpy.uint8:
+        return a
+    if a.dtype.kind in 'iu':
+        if a.ndim == 0:
+            return array_from_hex(a)
+        return a.astype(numpy.uint8)
+    return numpy.clip(a * 256.0 - 0.5, 0.0, 255.0).astype(numpy.uint8)
+
+def array_to_float(a):
+    """Convert an array of colors (last axis RGB) to float, as color_to_float does for a single color."""
+    a = numpy.asarray(a)
+    if a.dtype.kind in 'iu':
+        if a.ndim == 0:
+            a = array_from_hex(a)
+        return (a + 0.5) / 256.0
+    return a
+
+def array_mix(color0, color1, level):
+    """Mix arrays of colors, as mix_color does for a single color.
+
+    Either color may be a single color, which is used everywhere.  level is
+    a scalar, or an array with a level for each color (without the RGB axis)."""
+    f0 = array_to_float(color0)
+    f1 = array_to_float(color1)
+    level = numpy.asarray(level, float)
+    if level.ndim > 0:
+        level = level[..., numpy.newaxis]
+    return f1 * level + f0 * (1.0 - level)
+
+def check_frame_shape(frame, size):
+    if frame.shape != (size, size, size, 3):
+        raise Exception("Bad frame shape: %s" % (frame.shape,))
+
+class PixelBuffer(object):
+    """Drawing calls for a cube whose pixels are a uint8 (size, size, size, 3) array"""
+    def set_pixel(self, xyz, rgb):
+        (x, y, z) = xyz
+        sz = self.size
+        # Patterns written for the 8x8x8 cube draw past the edge of the
+        # small one, which the hardware protocol always ignored
+        if 0 <= x < sz and 0 <= y < sz and 0 <= z < sz:
+            self.pixels[x, y, z] = fast_color_to_int(rgb)
+
+    def set_frame(self, frame):
+        rgb = array_to_int(frame)
+        check_frame_shape(rgb, self.size)
+        self.pixels[...] = rgb
+
+    def get_frame(self):
+        return self.pixels
+
+    def clear(self):
+        self.pixels.fill(0)
@@ -0,0 +1,518 @@
+#! /usr/bin/env python
+
+# Local stand-in for an LED cube, for testing the drivers without hardware
+# Released under the terms of the GNU General Public License version 3
+
+import argparse
+import itertools
+import socket
+import sys
+import numpy
+import scheduler
+import serialcube
+
+# A keyframe this many frames behind the last one starts a new stream,
+# as does this many late frames in a row
+RESTART_GAP = 64
+RESTART_LATE = 8
+
+class UDPReceiver(object):
+    """Decodes the frame datagrams sent by serialcube.UDPWriter.
+
+    Frames that arrive after a newer one are dropped, as are deltas
+    whose base frame never arrived.  Those are fixed by the next keyframe.
+    A keyframe from well before the last frame, or a run of late frames,
+    means the sender has restarted, so the sequence starts again."""
+    def __init__(self, size):
+        self.size = size
+        self.pages = numpy.zeros((2, size * size * size, 3), numpy.uint8)
+        self.display_page = 0
+        # Deltas are relative to the last frame decoded, whichever page it went to
+        self.decoded_seq = None
+        self.brightness = None
+        self.last_seq = None
+        self.late_run = 0
+        self.errors = 0
+        self.last_error = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames = 0
+        self.bytes = 0
+        self.late = 0
+        self.lost = 0
+        self.skipped = 0
+
+    def error(self, msg):
+        self.errors += 1
+        self.last_error = msg
+        return False
+
+    def handle(self, data):
+        """Decode one datagram, and return True if it changed the display"""
+        self.bytes += len(data)
+        hdr = serialcube.UDP_HEADER
+        if len(data) < hdr.size:
+            return self.error("Short datagram")
+        (magic, seq, base, size, page, flags, r, g, b, count) = hdr.unpack(data[:hdr.size])
+        if magic != serialcube.UDP_MAGIC or size != self.size or page > 1:
+            return self.error("Bad datagram header")
+        payload = data[hdr.size:]
+        voxels = size * size * size
+        delta = flags & serialcube.UDP_DELTA
+        if delta:
+            expected = count * serialcube.UDP_DELTA_TYPE.itemsize
+        else:
+            expected = voxels * 3
+        if len(payload) != expected:
+            return self.error("Datagram payload is %d bytes, not %d" % (len(payload), expected))
+        if delta:
+            records = numpy.frombuffer(payload, serialcube.UDP_DELTA_TYPE, count)
+            if count > 0 and records['index'].max() >= voxels:
+                return self.error("Delta voxel index out of range")
+        if self.last_seq is not None:
+            gap = (seq - self.last_seq) & 0xffffffff
+            if gap == 0 or gap >= 0x80000000:
+                behind = (-gap) & 0xffffffff
+                self.late_run += 1
+                if (delta or behind <= RESTART_GAP) and self.late_run < RESTART_LATE:
+                    self.late += 1
+                    return False
+                # The sender has started again from the beginning
+                self.decoded_seq = None
+                gap = 1
+            self.lost += gap - 1
+        self.late_run = 0
+        self.last_seq = seq
+        if delta:
+            if self.decoded_seq != base:
+                self.skipped += 1
+                return False
+            if page != self.display_page:
+                self.pages[page] = self.pages[self.display_page]
+            self.pages[page][records['index']] = records['rgb']
+        else:
+            self.pages[page] = numpy.frombuffer(payload, numpy.uint8).reshape(-1, 3)
+        if flags & serialcube.UDP_BRIGHTNESS:
+            self.brightness = (r, g, b)
+        self.decoded_seq = seq
+        self.display_page = page
+        self.frames += 1
+        return True
+
+    def frame(self):
+        sz = self.size
+        return self.pages[self.display_page].reshape(sz, sz, sz, 3)
+
+    def stats(self):
+        stats = "late %d lost %d skipped %d" % (self.late, self.lost, self.skipped)
+        if self.errors == 0:
+            return stats
+        return "%s, %d errors so far, last: %s" % (stats, self.errors, self.last_error)
+
+MAPS = {4:serialcube.minicube_map, 8:serialcube.maxicube_map}
+RESET_WORD = b'\xff\xff\xff\xff'
+SYNC_WORD = b'\xe0\xf0\xf1\xf2'
+
+class CommandDecoder(object):
+    """Decodes the command stream sent by serialcube.Cube, as the boards would.
+
+    Each board keeps two pages of 128 pixels.  A frame is complete at a
+    flip, or at a bus reset that is not followed by a board select, which
+    is how a single buffered frame ends.  After a bad command everything up
+    to the next bus reset is ignored, as the boards would lose sync too."""
+    def __init__(self, size):
+        if size not in MAPS:
+            raise Exception("Bad cube size: %d" % size)
+        self.size = size
+        n = size * size * size
+        self.voxel_board = numpy.zeros(n, numpy.intp)
+        self.voxel_offset = numpy.zeros(n, numpy.intp)
+        for (index, xyz) in enumerate(itertools.product(range(size), repeat=3)):
+            (self.voxel_board[index], self.voxel_offset[index]) = MAPS[size](xyz)
+        self.boards = set(self.voxel_board.tolist())
+        self.pages = numpy.zeros((2, 256, 128, 3), numpy.uint8)
+        self.display_page = 0
+        self.write_page = 0
+        self.board = None
+        self.brightness = None
+        self.pending = b''
+        self.synced = True
+        # A bus reset was the last command, so a frame may have ended
+        self.after_reset = False
+        self.errors = 0
+        self.last_error = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def reset_stream(self):
+        """A new connection starts on a command boundary"""
+        self.pending = b''
+        self.synced = True
+        self.after_reset = False
+
+    def error(self, msg):
+        self.errors += 1
+        self.last_error = msg
+        self.synced = False
+        self.board = None
+        self.after_reset = False
+
+    def feed(self, data):
+        """Decode more of the stream, and return True if a frame completed"""
+        self.bytes += len(data)
+        frames = self.frames
+        buf = self.pending + data
+        while True:
+            if not self.synced:
+                pos = buf.find(RESET_WORD)
+                if pos < 0:
+                    self.pending = buf[-3:]
+                    break
+                buf = buf[pos:]
+                self.synced = True
+            n = len(buf) - len(buf) % 4
+            used = self.decode(numpy.frombuffer(buf, numpy.uint8, n).reshape(-1, 4))
+            buf = buf[used * 4:]
+            if self.synced:
+                self.pending = buf
+                break
+        return self.frames != frames
+
+    def decode(self, cmds):
+        """Decode whole commands, and return how many were used"""
+        # Runs of pixel writes are stored in one go, control commands one at a time
+        control = numpy.flatnonzero(cmds[:, 0] >= 0x80)
+        pos = 0
+        for n in itertools.chain(control.tolist(), [len(cmds)]):
+            if n > pos:
+                if self.after_reset:
+                    self.end_frame()
+                if self.board is None:
+                    self.error("Pixel data with no board selected")
+                    return pos + 1
+                pixels = cmds[pos:n]
+                if self.board == 0xff:
+                    self.pages[self.write_page][:, pixels[:, 0]] = pixels[:, 1:]
+                else:
+                    self.pages[self.write_page, self.board, pixels[:, 0]] = pixels[:, 1:]
+            if n == len(cmds):
+                break
+            if not self.command(cmds[n]):
+                return n + 1
+            pos = n + 1
+        return len(cmds)
+
+    def command(self, c):
+        """Decode a control command, and return False if it was bad"""
+        cmd = int(c[0])
+        if cmd == 0xff:
+            if c.tobytes() != RESET_WORD:
+                self.error("Bad bus reset")
+                return False
+            if self.after_reset:
+                self.end_frame()
+            self.board = None
+            return True
+        if cmd == 0xe0:
+            if c.tobytes() != SYNC_WORD:
+                self.error("Bad bus reset")
+                return False
+            self.after_reset = True
+            return True
+        if self.after_reset and cmd != 0xe1:
+            self.end_frame()
+        self.after_reset = False
+        if cmd == 0xe1:
+            board = int(c[1])
+            if board != 0xff and board not in self.boards:
+                self.error("Select of missing board %d" % board)
+                return False
+            self.board = board
+        elif cmd == 0xc0:
+            if self.board != 0xff:
+                self.error("Brightness not broadcast")
+                return False
+            self.brightness = (int(c[1]), int(c[2]), int(c[3]))
+        elif cmd == 0x80:
+            if c[2] > 1 or c[3] > 1:
+                self.error("Flip to bad page")
+                return False
+            self.display_page = int(c[2])
+            self.write_page = int(c[3])
+            self.end_frame()
+        else:
+            self.error("Bad command 0x%02x" % cmd)
+            return False
+        return True
+
+    def end_frame(self):
+        self.after_reset = False
+        self.frames += 1
+
+    def flush(self):
+        """The stream has paused, so a trailing bus reset ends the frame.
+
+        Returns True if a frame completed."""
+        frames = self.frames
+        if self.after_reset:
+            self.end_frame()
+        return self.frames != frames
+
+    def frame(self):
+        sz = self.size
+        page = self.pages[self.display_page]
+        return page[self.voxel_board, self.voxel_offset].reshape(sz, sz, sz, 3)
+
+    def stats(self):
+        if self.errors == 0:
+            return "no errors"
+        return "%d errors so far, last: %s" % (self.errors, self.last_error)
+
+def open_viewer(size):
+    import glcube
+    return glcube.Cube(argparse.Namespace(size=size))
+
+class Monitor(object):
+    """Shows decoded frames, and reports the rates once a second"""
+    def __init__(self, receiver, viewer):
+        self.receiver = receiver
+        self.viewer = viewer
+        self.start = scheduler.monotonic()
+        self.next_report = self.start + 1.0
+        self.total_frames = 0
+        self.total_bytes = 0
+
+    def update(self, changed):
+        r = self.receiver
+        if changed and self.viewer is not None:
+            self.viewer.set_frame(r.frame())
+            self.viewer.render()
+        now = scheduler.monotonic()
+        if now >= self.next_report:
+            self.report()
+            self.next_report += 1.0
+
+    def report(self):
+        r = self.receiver
+        print("%d frames/s %.0f bytes/frame %s" % (r.frames,
+            per_frame(r.bytes, r.frames), r.stats()))
+        self.collect()
+
+    def collect(self):
+        r = self.receiver
+        self.total_frames += r.frames
+        self.total_bytes += r.bytes
+        r.reset_stats()
+
+    def summary(self):
+        self.collect()
+        elapsed = scheduler.monotonic() - self.start
+        print("%d frames in %.2fs, %.0f frames/s %.0f bytes/frame" % (self.total_frames,
+            elapsed, self.total_frames / max(elapsed, 1e-6),
+            per_frame(self.total_bytes, self.total_frames)))
+        print(self.receiver.stats())
+
+def per_frame(nbytes, frames):
+    if frames > 0:
+        return nbytes / float(frames)
+    return 0.0
+
+def serve_udp(port, size, viewer):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', port))
+    sock.settimeout(0.1)
+    monitor = Monitor(UDPReceiver(size), viewer)
+    while True:
+        try:
+            data = sock.recv(65536)
+            monitor.update(monitor.receiver.handle(data))
+        except socket.timeout:
+            monitor.update(False)
+
+def serve_tcp(port, size, viewer):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', port))
+    listener.listen(1)
+    decoder = CommandDecoder(size)
+    while True:
+        (conn, addr) = listener.accept()
+        print("Connection from %s:%d" % addr[:2])
+        conn.settimeout(0.1)
+        decoder.reset_stream()
+        monitor = Monitor(decoder, viewer)
+        while True:
+            try:
+                data = conn.recv(65536)
+            except socket.timeout:
+                monitor.update(decoder.flush())
+                continue
+            if len(data) == 0:
+                break
+            monitor.update(decoder.feed(data))
+        conn.close()
+        decoder.flush()
+        monitor.summary()
+
+def read_file(name, size, viewer):
+    """Decode a stream written with --port file:NAME, or piped in if NAME is '-'"""
+    if name == '-':
+        f = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        f = open(name, 'rb')
+    decoder = CommandDecoder(size)
+    monitor = Monitor(decoder, viewer)
+    while True:
+        data = f.read(65536)
+        if len(data) == 0:
+            break
+        monitor.update(decoder.feed(data))
+    monitor.update(decoder.flush())
+    if len(decoder.pending) > 0:
+        print("%d trailing bytes" % len(decoder.pending))
+    monitor.summary()
+
+class LossyWriter(object):
+    """Collects the command stream, losing the write numbered lose, and
+    reports the loss through sync() as ThreadedWriter and TCPWriter do"""
+    def __init__(self, lose):
+        self.lose = lose
+        self.count = 0
+        self.lost = False
+        self.data = []
+
+    def sync(self):
+        ok = not self.lost
+        self.lost = False
+        return ok
+
+    def write(self, b):
+        self.count += 1
+        if self.count == self.lose:
+            self.lost = True
+        else:
+            self.data.append(numpy.asarray(b, numpy.uint8).tobytes())
+
+    def received(self):
+        data = b''.join(self.data)
+        self.data = []
+        return data
+
+    def close(self):
+        pass
+
+class LossyLink(object):
+    """A serialcube.TCPWriter to a local socket, with the link down for
+    the write numbered lose"""
+    def __init__(self, lose):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('localhost', 0))
+        listener.listen(1)
+        self.writer = serialcube.TCPWriter('localhost:%d' % listener.getsockname()[1])
+        (self.conn, addr) = listener.accept()
+        listener.close()
+        self.conn.settimeout(0.05)
+        self.lose = lose
+        self.count = 0
+
+    def sync(self):
+        return self.writer.sync()
+
+    def write(self, b):
+        self.count += 1
+        sock = self.writer.sock
+        if self.count == self.lose:
+            # As if the connection had dropped and was being remade
+            self.writer.sock = None
+        self.writer.write(b)
+        self.writer.sock = sock
+
+    def received(self):
+        data = []
+        try:
+            while True:
+                data.append(self.conn.recv(65536))
+        except socket.timeout:
+            pass
+        return b''.join(data)
+
+    def close(self):
+        self.writer.sock.close()
+        self.conn.close()
+
+def check_dropped_write(size, writer, frames=40):
+    """Run a double buffered serialcube.Cube through a writer that loses
+    a write, and return the numbers of the frames shown wrongly"""
+    c = serialcube.Cube(argparse.Namespace(size=size, port='@/dev/null'))
+    c.ser.close()
+    c.ser = writer
+    decoder = CommandDecoder(size)
+    rng = numpy.random.RandomState(0)
+    frame = numpy.zeros((size, size, size, 3), numpy.uint8)
+    wrong = []
+    c.clear()
+    c.swap()
+    for n in range(frames):
+        # Change a few voxels at a time, so most of each frame is a delta
+        frame = frame.copy()
+        for i in range(3):
+            frame[tuple(rng.randint(0, size, 3))] = rng.randint(1, 256, 3)
+        c.set_frame(frame)
+        c.swap()
+        decoder.feed(writer.received())
+        if not numpy.array_equal(decoder.frame(), frame):
+            wrong.append(n)
+    writer.close()
+    if decoder.errors > 0:
+        raise Exception("Bad command stream: %s" % decoder.stats())
+    return wrong
+
+def run_checks(size):
+    """Check that the driver recovers within two frames of a lost write"""
+    lose = 10
+    ok = True
+    for (name, writer) in (('write', LossyWriter), ('TCP write', LossyLink)):
+        wrong = check_dropped_write(size, writer(lose))
+        # The first write is the initial swap, so the lost write is frame
+        # lose - 2, and every frame after the next one must be right
+        passed = all(n < lose for n in wrong)
+        print("Lost %s %d, wrong frames %s: %s" % (name, lose, wrong,
+            "ok" if passed else "FAILED"))
+        ok = ok and passed
+    return ok
+
+def main():
+    ap = argparse.ArgumentParser(description="LED cube simulator")
+    ap.add_argument('source', type=str,
+            help="Where to receive frames from: tcp:PORT, file:NAME (- for stdin) or udp:PORT, "
+                 "or 'check' to test the serial driver")
+    ap.add_argument('-s', '--size', type=int, default=8,
+            help="Cube size")
+    ap.add_argument('-v', '--view', action='store_true', default=False,
+            help="Show the frames in the OpenGL simulator")
+    args = ap.parse_args()
+    if args.view:
+        viewer = open_viewer(args.size)
+    else:
+        viewer = None
+    if args.source == 'check':
+        sys.exit(0 if run_checks(args.size) else 1)
+    (proto, port) = args.source.split(':', 1)
+    try:
+        if proto == 'tcp':
+            serve_tcp(int(port), args.size, viewer)
+        elif proto == 'file':
+            read_file(port, args.size, viewer)
+        elif proto == 'udp':
+            serve_udp(int(port), args.size, viewer)
+        else:
+            raise Exception("Bad source: '%s'" % args.source)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
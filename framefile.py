@@ -0,0 +1,163 @@
+# Recording and playback of LED cube frame streams
+# Released under the terms of the GNU General Public License version 3
+#
+# File layout:
+#   header: magic, cube size, compression
+#   frame data, one record per frame
+#   index: offset, length, timestamp, pattern and keyframe flag per frame
+#   pattern names, as JSON
+#   footer: index offset, frame count, names offset, names length, magic
+#
+# Uncompressed frames are stored back to back as uint8 (x, y, z, rgb)
+# arrays, so the file can be memory mapped.  With delta compression each
+# frame is XORed with the previous one before being zlib compressed, with
+# a keyframe every KEYFRAME_INTERVAL frames so seeking stays cheap.
+
+import json
+import struct
+import zlib
+import numpy
+import scheduler
+
+HEADER = struct.Struct('<8sHH4x')
+FOOTER = struct.Struct('<QIQI8s')
+HEADER_MAGIC = b'CUBEREC1'
+FOOTER_MAGIC = b'CUBEEND1'
+INDEX_TYPE = numpy.dtype([('offset', '<u8'), ('length', '<u4'), ('timestamp', '<f8'),
+                          ('pattern', '<u2'), ('keyframe', 'u1')])
+COMPRESSION = {'raw':0, 'zlib':1, 'delta':2}
+KEYFRAME_INTERVAL = 64
+
+class FrameWriter(object):
+    def __init__(self, filename, size, compression='raw'):
+        if compression not in COMPRESSION:
+            raise Exception("Bad compression: '%s'" % compression)
+        self.f = open(filename, 'wb')
+        self.size = size
+        self.compression = compression
+        self.f.write(HEADER.pack(HEADER_MAGIC, size, COMPRESSION[compression]))
+        self.index = []
+        self.names = []
+        self.name_ids = {}
+        self.previous = None
+
+    def add(self, frame, timestamp, pattern=''):
+        frame = numpy.ascontiguousarray(frame, numpy.uint8)
+        if frame.shape != (self.size, self.size, self.size, 3):
+            raise Exception("Bad frame shape: %s" % (frame.shape,))
+        if pattern not in self.name_ids:
+            self.name_ids[pattern] = len(self.names)
+            self.names.append(pattern)
+        keyframe = (self.compression != 'delta' or len(self.index) % KEYFRAME_INTERVAL == 0)
+        if self.compression == 'raw':
+            data = frame.tobytes()
+        elif keyframe:
+            data = zlib.compress(frame.tobytes())
+        else:
+            data = zlib.compress(numpy.bitwise_xor(frame, self.previous).tobytes())
+        self.previous = frame.copy()
+        self.index.append((self.f.tell(), len(data), timestamp, self.name_ids[pattern], keyframe))
+        self.f.write(data)
+
+    def close(self):
+        index = numpy.array(self.index, INDEX_TYPE)
+        index_offset = self.f.tell()
+        self.f.write(index.tobytes())
+        names = json.dumps(self.names).encode('utf-8')
+        names_offset = self.f.tell()
+        self.f.write(names)
+        self.f.write(FOOTER.pack(index_offset, len(index), names_offset, len(names), FOOTER_MAGIC))
+        self.f.close()
+
+class FrameReader(object):
+    def __init__(self, filename):
+        f = open(filename, 'rb')
+        f.seek(0, 2)
+        length = f.tell()
+        f.seek(0)
+        if length < HEADER.size:
+            raise Exception("Bad recording: '%s'" % filename)
+        (magic, size, compression) = HEADER.unpack(f.read(HEADER.size))
+        if magic != HEADER_MAGIC:
+            raise Exception("Bad recording: '%s'" % filename)
+        if length < HEADER.size + FOOTER.size:
+            raise Exception("Truncated recording: '%s'" % filename)
+        f.seek(-FOOTER.size, 2)
+        (index_offset, count, names_offset, names_len, magic) = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != FOOTER_MAGIC:
+            raise Exception("Truncated recording: '%s'" % filename)
+        f.seek(index_offset)
+        self.index = numpy.frombuffer(f.read(count * INDEX_TYPE.itemsize), INDEX_TYPE)
+        f.seek(names_offset)
+        self.names = json.loads(f.read(names_len).decode('utf-8'))
+        self.size = size
+        self.compression = compression
+        self.timestamps = self.index['timestamp']
+        self.shape = (size, size, size, 3)
+        self.data = numpy.memmap(f, numpy.uint8, 'r')
+        f.close()
+        self.cached = (None, None)
+
+    def __len__(self):
+        return len(self.index)
+
+    def pattern(self, n):
+        return self.names[self.index[n]['pattern']]
+
+    def _payload(self, n):
+        entry = self.index[n]
+        start = int(entry['offset'])
+        return self.data[start:start + int(entry['length'])]
+
+    def _unpack(self, n):
+        data = zlib.decompress(self._payload(n).tobytes())
+        return numpy.frombuffer(data, numpy.uint8).reshape(self.shape)
+
+    def frame(self, n):
+        """Return frame n as a uint8 array, which may be read only"""
+        if self.compression == COMPRESSION['raw']:
+            return self._payload(n).reshape(self.shape)
+        if self.compression == COMPRESSION['zlib']:
+            return self._unpack(n)
+        (cached_n, frame) = self.cached
+        key = n - n % KEYFRAME_INTERVAL
+        if cached_n is None or cached_n > n or cached_n < key:
+            cached_n = key
+            frame = self._unpack(key)
+        while cached_n < n:
+            cached_n += 1
+            frame = numpy.bitwise_xor(frame, self._unpack(cached_n))
+        self.cached = (n, frame)
+        return frame
+
+    def find(self, timestamp):
+        """Return the last frame due at or before timestamp"""
+        return max(int(numpy.searchsorted(self.timestamps, timestamp, 'right')) - 1, 0)
+
+class Recorder(object):
+    """Wraps a cube, recording every rendered frame"""
+    def __init__(self, cube, filename, compression='raw'):
+        self.cube = cube
+        self.writer = FrameWriter(filename, cube.size, compression)
+        self.start = scheduler.monotonic()
+        self.pattern_name = ''
+        self.size = cube.size
+        self.color = cube.color
+        self.set_pixel = cube.set_pixel
+        self.set_frame = cube.set_frame
+        self.get_frame = cube.get_frame
+        self.clear = cube.clear
+        self.swap = cube.swap
+        self.single_buffer = cube.single_buffer
+        self.set_brightness = cube.set_brightness
+        if hasattr(cube, 'idle'):
+            self.idle = cube.idle
+
+    def render(self):
+        t = scheduler.monotonic() - self.start
+        self.writer.add(self.cube.get_frame(), t, self.pattern_name)
+        self.cube.render()
+
+    def close(self):
+        self.writer.close()
+        self.cube.close()
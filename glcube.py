@@ -9,23 +9,30 @@ from OpenGL.arrays import vbo
 import pygame
 import pygame.locals as pgl
 import numpy
+import math
+import time
 import cubehelper
+import scheduler
 
+# Each voxel is one instance of the pixel model, with its own offset and color
 vertex_code = """
 attribute vec3 position;
+attribute vec3 offset;
+attribute vec3 color;
 uniform mat4 proj;
-uniform vec3 offset;
+varying vec3 voxel_color;
 void main()
 {
+    voxel_color = color;
     gl_Position = proj * vec4(position + offset, 1.0);
 }
 """
 
 fragment_code = """
-uniform vec3 color;
+varying vec3 voxel_color;
 void main()
 {
-    gl_FragColor = vec4(color, 1.0);
+    gl_FragColor = vec4(voxel_color, 1.0);
 }
 """
 
@@ -60,8 +67,8 @@ class Model(object):
         self.ind_vbo.bind()
         glVertexAttribPointer(attr, 3, GL_FLOAT, GL_FALSE, 12, self.vec_vbo)
 
-    def render(self):
-        glDrawElements(GL_TRIANGLES, self.ind_count, GL_UNSIGNED_SHORT, self.ind_vbo)
+    def render(self, instances):
+        glDrawElementsInstanced(GL_TRIANGLES, self.ind_count, GL_UNSIGNED_SHORT, self.ind_vbo, instances)
 
 def m0_projection(aspect, n, f):
     return numpy.array([[1.0, 0.0, 0.0, 0.0],
@@ -77,6 +84,13 @@ class Cube(object):
         size = args.size
         self.size = size
         self.pixels = numpy.zeros((size, size, size, 3), 'f')
+        # What is currently on screen, None forces a redraw
+        self.shown = None
+        # Seconds per camera orbit, 0 for a fixed camera
+        self.orbit = getattr(args, 'orbit', 0.0)
+        self.display_interval = 1.0 / getattr(args, 'display_rate', 30.0)
+        self.angle = 0.0
+        self.start = scheduler.monotonic()
         pygame.init()
         video_flags = pgl.OPENGL | pgl.DOUBLEBUF
         pygame.display.set_mode((width, height), video_flags)
@@ -91,16 +105,36 @@ class Cube(object):
         program = shaders.compileProgram(vertex, fragment)
         self.shader = program
         self.attr_position = glGetAttribLocation(program, "position")
-        self.param_color = glGetUniformLocation(program, "color")
+        self.attr_offset = glGetAttribLocation(program, "offset")
+        self.attr_color = glGetAttribLocation(program, "color")
         self.param_proj = glGetUniformLocation(program, "proj")
-        self.param_offset = glGetUniformLocation(program, "offset")
 
     def geometry_init(self):
+        if not glDrawElementsInstanced or not glVertexAttribDivisor:
+            raise Exception("OpenGL instanced rendering is not supported")
         self.pixel_model = Model("pixel.off")
+        size = self.size
+        self.spacing = 5.0
+        offsets = numpy.indices((size, size, size), 'f').reshape(3, -1).T * self.spacing
+        self.offset_vbo = vbo.VBO(numpy.ascontiguousarray(offsets))
+        self.color_vbo = vbo.VBO(self.pixels.reshape(-1, 3), usage=GL_DYNAMIC_DRAW)
+
+    def bind_instance_attr(self, attr, buf):
+        buf.bind()
+        glEnableVertexAttribArray(attr)
+        glVertexAttribPointer(attr, 3, GL_FLOAT, GL_FALSE, 12, buf)
+        glVertexAttribDivisor(attr, 1)
 
     def set_pixel(self, xyz, rgb):
-        rgb = cubehelper.color_to_float(rgb)
-        self.pixels[tuple(xyz)] = rgb
+        self.pixels[tuple(xyz)] = cubehelper.fast_color_to_float(rgb)
+
+    def set_frame(self, frame):
+        rgb = cubehelper.array_to_float(frame)
+        cubehelper.check_frame_shape(rgb, self.size)
+        self.pixels[...] = rgb
+
+    def get_frame(self):
+        return cubehelper.array_to_int(self.pixels)
 
     def clear(self):
         self.pixels.fill(0.0)
@@ -112,31 +146,39 @@ class Cube(object):
         # We are effectively double buffered, so no need to do anything here
         pass
 
-    def render(self):
+    def update_camera(self):
+        if self.orbit > 0:
+            t = (scheduler.monotonic() - self.start) / self.orbit
+            self.angle = math.pi * 2.0 * (t - math.floor(t))
+
+    def eye_matrix(self):
+        # Orbit the camera around the vertical (z) axis through the cube centre
+        spacing = self.spacing
+        c = (self.size / 2 - 0.5) * spacing
+        zoff = (self.size / 2 + 1) * spacing
+        ca = math.cos(self.angle)
+        sa = math.sin(self.angle)
+        eye = numpy.array([[ca, -sa, 0.0, (sa - ca) * c],
+                           [0.0, 0.0, 1.0, -c],
+                           [sa, ca, 0.0, c + zoff - (sa + ca) * c],
+                           [0.0, 0.0, 0.0, 1.0]
+                          ], 'f')
+        return numpy.dot(self.projection, eye)
+
+    def draw(self):
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         glUseProgram(self.shader)
+        self.color_vbo.set_array(self.pixels.reshape(-1, 3))
+        self.bind_instance_attr(self.attr_offset, self.offset_vbo)
+        self.bind_instance_attr(self.attr_color, self.color_vbo)
         glEnableVertexAttribArray(self.attr_position)
         self.pixel_model.bind(self.attr_position)
-
-        spacing = 5.0
-        xoff = (self.size / 2 - 0.5) * -spacing
-        yoff = (self.size / 2 - 0.5) * -spacing
-        zoff = (self.size / 2 + 1) * spacing
-        eye = numpy.array([[1.0, 0.0, 0.0, xoff],
-                            [0.0, 0.0, 1.0, yoff],
-                            [0.0, 1.0, 0.0, zoff],
-                            [0.0, 0.0, 0.0, 1.0]
-                           ], 'f')
-        eye = numpy.dot(self.projection, eye)
-        glUniformMatrix4fv(self.param_proj, 1, GL_TRUE, eye)
-        for x in range(0, self.size):
-            for y in range(0, self.size):
-                for z in range(0, self.size):
-                    (r, g, b) = self.pixels[x, y, z]
-                    glUniform3f(self.param_color, r, g, b)
-                    glUniform3f(self.param_offset, x * spacing, y * spacing, z * spacing)
-                    self.pixel_model.render()
+        glUniformMatrix4fv(self.param_proj, 1, GL_TRUE, self.eye_matrix())
+        self.pixel_model.render(self.size ** 3)
         pygame.display.flip()
+        self.shown = (self.pixels.copy(), self.angle)
+
+    def poll_events(self):
         for event in pygame.event.get():
             if event.type == pgl.QUIT:
                 raise KeyboardInterrupt
@@ -145,3 +187,26 @@ class Cube(object):
                     raise KeyboardInterrupt
                 if event.key == pgl.K_SPACE:
                     raise StopIteration
+
+    def render(self):
+        self.update_camera()
+        shown = self.shown
+        if shown is None or shown[1] != self.angle or not numpy.array_equal(shown[0], self.pixels):
+            self.draw()
+        self.poll_events()
+
+    def idle(self, seconds):
+        """Keep the window responsive (and the camera moving) while waiting for the next frame"""
+        deadline = scheduler.monotonic() + seconds
+        while True:
+            self.poll_events()
+            now = scheduler.monotonic()
+            if now >= deadline:
+                return
+            if self.orbit > 0:
+                self.update_camera()
+                self.draw()
+            time.sleep(min(self.display_interval, deadline - now))
+
+    def close(self):
+        pygame.quit()
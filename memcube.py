@@ -0,0 +1,30 @@
+# Headless in-memory LED cube, for benchmarking and testing patterns
+# Released under the terms of the GNU General Public License version 3
+
+import numpy
+import cubehelper
+
+class Cube(cubehelper.PixelBuffer):
+    def __init__(self, args):
+        self.color = True
+        size = args.size
+        self.size = size
+        self.pixels = numpy.zeros((size, size, size, 3), numpy.uint8)
+        self.brightness = (0xff, 0xff, 0xff)
+        self.double_buffered = False
+        self.frames = 0
+
+    def set_brightness(self, rgb):
+        self.brightness = tuple(rgb)
+
+    def single_buffer(self):
+        self.double_buffered = False
+
+    def swap(self):
+        self.double_buffered = True
+
+    def render(self):
+        self.frames += 1
+
+    def close(self):
+        pass
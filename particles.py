@@ -0,0 +1,78 @@
+# Particle systems for LED cube patterns
+# Released under the terms of the GNU General Public License version 3
+#
+# Particles are held as a structure of arrays, so a whole system is
+# moved, faded and drawn with a handful of numpy operations however many
+# particles there are.  Positions are in cube coordinates, 0.0 to 1.0
+# along each axis, with z up.
+
+import numpy
+
+class ParticleSystem(object):
+    """A set of particles sharing the same physics.
+
+    gravity is subtracted from the z velocity every second, and drag is
+    the fraction of velocity left after one second.  Particles stop
+    dead on the floor, and are held inside the other faces."""
+    def __init__(self, gravity=0.0, drag=1.0):
+        self.gravity = gravity
+        self.drag = drag
+        self.pos = numpy.zeros((0, 3))
+        self.vel = numpy.zeros((0, 3))
+        self.color = numpy.zeros((0, 3))
+        self.level = numpy.zeros(0)
+        self.fade = numpy.zeros(0)
+        self.age = numpy.zeros(0)
+        self.lifetime = numpy.zeros(0)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def emit(self, pos, vel, color, fade=0.0, lifetime=numpy.inf, level=1.0):
+        """Add particles.  pos and vel are (N, 3) arrays; color, fade,
+        lifetime and level are either one value for all of them or one
+        per particle.  level drops by fade each second, and a particle
+        dies when it reaches zero or its age reaches lifetime."""
+        vel = numpy.asarray(vel, float)
+        n = len(vel)
+        def column(v):
+            return numpy.broadcast_to(numpy.asarray(v, float), (n,))
+        self.pos = numpy.concatenate((self.pos, numpy.broadcast_to(pos, (n, 3))))
+        self.vel = numpy.concatenate((self.vel, vel))
+        self.color = numpy.concatenate((self.color, numpy.broadcast_to(color, (n, 3))))
+        self.level = numpy.concatenate((self.level, column(level)))
+        self.fade = numpy.concatenate((self.fade, column(fade)))
+        self.age = numpy.concatenate((self.age, numpy.zeros(n)))
+        self.lifetime = numpy.concatenate((self.lifetime, column(lifetime)))
+
+    def step(self, dt):
+        """Advance by dt seconds.  Returns the positions and colors of
+        the particles that reached their lifetime, which are removed
+        along with those that faded out."""
+        vel = self.vel
+        vel *= self.drag ** dt
+        vel[:, 2] -= self.gravity * dt
+        pos = self.pos
+        pos += vel * dt
+        floor = pos < 0.0
+        pos[floor] = 0.0
+        vel[floor] = 0.0
+        numpy.minimum(pos, 1.0, out=pos)
+        self.level -= self.fade * dt
+        self.age += dt
+        expired = self.age >= self.lifetime
+        done = (self.pos[expired], self.color[expired])
+        keep = ~expired & (self.level > 0.0)
+        if not keep.all():
+            for name in ('pos', 'vel', 'color', 'level', 'fade', 'age', 'lifetime'):
+                setattr(self, name, getattr(self, name)[keep])
+        return done
+
+    def splat(self, frame):
+        """Add each particle's color, scaled by its level, to the voxel it
+        is in.  frame is a float (size, size, size, 3) array."""
+        sz = frame.shape[0]
+        index = (self.pos * sz - 0.001).astype(numpy.intp)
+        numpy.clip(index, 0, sz - 1, out=index)
+        numpy.add.at(frame, (index[:, 0], index[:, 1], index[:, 2]),
+                self.color * self.level[:, numpy.newaxis])
@@ -0,0 +1,170 @@
+# Pattern loading for the LED cube demos
+# Copyright (C) Paul Brook <paul@nowt.org>
+# Released under the terms of the GNU General Public License version 3
+
+import json
+import os
+import random
+import sys
+import scheduler
+
+try:
+    import importlib.util
+    spec_from_file_location = importlib.util.spec_from_file_location
+except (ImportError, AttributeError):
+    import imp
+    spec_from_file_location = None
+
+PATTERN_DIR = "patterns"
+CACHE_FILE = ".index.json"
+
+def is_credit(l):
+    return l.split(':')[0].split(' ')[0] in ('Copyright', 'Author', 'Released')
+
+def describe_file(filename):
+    """Return the first line of a module's header comment or docstring"""
+    docstring = False
+    with open(filename) as f:
+        for (n, l) in enumerate(f):
+            if n >= 20:
+                break
+            l = l.strip()
+            if l.startswith('#!') or l == '':
+                continue
+            if docstring:
+                l = l.strip('"\'').strip()
+            elif l.startswith('#'):
+                l = l.lstrip('#').strip()
+            elif l.startswith('"""') or l.startswith("'''"):
+                docstring = True
+                l = l.strip('"\'').strip()
+            else:
+                break
+            if l != '' and not is_credit(l):
+                return l
+    return ''
+
+def import_file(name, filename):
+    if spec_from_file_location is None:
+        return imp.load_source(name, filename)
+    if os.path.basename(filename) == '__init__.py':
+        spec = spec_from_file_location(name, filename,
+                submodule_search_locations=[os.path.dirname(filename)])
+    else:
+        spec = spec_from_file_location(name, filename)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    try:
+        spec.loader.exec_module(mod)
+    except:
+        del sys.modules[name]
+        raise
+    return mod
+
+class PatternRegistry(object):
+    """Index of the available patterns.
+
+    Names and descriptions are read from the source without importing
+    anything, and cached on disk until a file's mtime changes.  Modules
+    are only imported when a pattern is first loaded."""
+    def __init__(self, path=PATTERN_DIR):
+        self.path = path
+        self.cache_file = os.path.join(path, CACHE_FILE)
+        self.index = {}
+        self.import_times = {}
+        self.refresh()
+
+    def refresh(self):
+        try:
+            with open(self.cache_file) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            cached = {}
+        index = {}
+        for entry in sorted(os.listdir(self.path)):
+            filename = os.path.join(self.path, entry)
+            if entry.startswith('.'):
+                continue
+            elif entry.endswith('.py'):
+                name = entry[:-3]
+            elif os.path.isfile(os.path.join(filename, '__init__.py')):
+                name = entry
+                filename = os.path.join(filename, '__init__.py')
+            else:
+                continue
+            mtime = os.path.getmtime(filename)
+            info = cached.get(name)
+            if info is None or info['file'] != filename or info['mtime'] != mtime:
+                info = {'file':filename, 'mtime':mtime, 'description':describe_file(filename)}
+            index[name] = info
+        self.index = index
+        if index != cached:
+            try:
+                with open(self.cache_file, 'w') as f:
+                    json.dump(index, f, indent=1, sort_keys=True)
+            except (IOError, OSError):
+                pass
+
+    def names(self):
+        return sorted(self.index.keys())
+
+    def describe(self, name):
+        return self.index[name]['description']
+
+    def load(self, name, cube, arg=None):
+        """Import a pattern module and construct its Pattern, or return None on failure"""
+        if name not in self.index:
+            print("Unknown pattern '%s'" % name)
+            return None
+        start = scheduler.monotonic()
+        try:
+            mod = import_file(name, self.index[name]['file'])
+            constructor = mod.Pattern
+        except Exception as e:
+            print(e)
+            print("Failed to load pattern '%s'" % name)
+            return None
+        elapsed = scheduler.monotonic() - start
+        self.import_times[name] = elapsed
+        print("Loaded pattern module '%s' in %.1fms" % (name, elapsed * 1000.0))
+        pobj = constructor()
+        pobj.name = name
+        pobj.cube = cube
+        pobj.arg = arg
+        return pobj
+
+def iter_patterns(registry, cube, namelist, noloop):
+    # Patterns are loaded the first time they come up, then reused
+    loaded = {}
+    while True:
+        found = False
+        for (name, arg) in namelist:
+            if name not in loaded:
+                loaded[name] = registry.load(name, cube, arg)
+            if loaded[name] is not None:
+                found = True
+                yield loaded[name]
+        if not found:
+            raise Exception("No patterns found")
+        if noloop:
+            return
+
+def load_patterns(cube, match, noloop=False, registry=None):
+    if registry is None:
+        registry = PatternRegistry()
+    if match is None:
+        names = registry.names()
+        random.shuffle(names)
+        namelist = [(name, None) for name in names]
+    else:
+        args = {}
+        names = []
+        for name in match:
+            if ':' in name:
+                (name, arg) = name.split(':', 1)
+            else:
+                arg = None
+            names.append(name)
+            args[name] = arg
+        namelist = [(name, args[name]) for name in names]
+    return iter_patterns(registry, cube, namelist, noloop)
@@ -5,6 +5,7 @@
 import cubehelper
 import math
 import random
+import numpy
 
 # range is inclusive
 def in_range(x, a, b):
@@ -56,17 +57,12 @@ class Pattern(object):
         outer = self.offset
         inner = self.offset - 4
 
-        for y in range(self.cube.size):
-            dy = abs(y - pos[1])
-            for x in range(self.cube.size):
-                dx = abs(x - pos[0])
-                for z in range(self.cube.size):
-                    dz = abs(z - pos[2])
-                    if max(dx, dy, dz) >= inner and max(dx, dy, dz) <= outer:
-                        color = self.filling_color
-                    else:
-                        color = 0
-                    self.cube.set_pixel((x, y, z), color)
+        sz = self.cube.size
+        (x, y, z) = numpy.ogrid[0:sz, 0:sz, 0:sz]
+        dist = numpy.maximum(numpy.maximum(abs(x - pos[0]), abs(y - pos[1])), abs(z - pos[2]))
+        frame = numpy.zeros((sz, sz, sz, 3))
+        frame[(dist >= inner) & (dist <= outer)] = self.filling_color
+        self.cube.set_frame(frame)
 
         if inner == self.cube.size:
             self.restart()
@@ -3,6 +3,7 @@
 # Released under the terms of the GNU General Public License version 3
 
 import cubehelper
+import numpy
 
 class Pattern(object):
     def init(self):
@@ -12,10 +13,10 @@ class Pattern(object):
         return 1.0/16
     def tick(self):
         color = cubehelper.mix_color((0.0,0.0,0.0), self.color, self.level)
-        for y in range(0, self.cube.size):
-            for z in range(0, self.cube.size):
-                for x in range(0, self.cube.size):
-                    self.cube.set_pixel((x, y, z), color)
+        sz = self.cube.size
+        frame = numpy.empty((sz, sz, sz, 3))
+        frame[...] = color
+        self.cube.set_frame(frame)
         self.level += self.delta
         if self.level >= 1.0:
             self.delta = -self.delta
@@ -3,94 +3,80 @@
 # Released under the terms of the GNU General Public License version 3
 
 import cubehelper
+import particles
 import random
 import math
+import numpy
 
 # Frame delta-time
 DT = 1.0/16
 GRAVITY = 2.0
 CLIMB = 2.0
-FRICTION = math.pow(0.005, DT)
+# Fraction of spark speed left after one second
+DRAG = 0.005
 FADE = 0.5
 # Detonation height
-APEX = 0.8
+APEX = (0.6, 0.85)
 # speed after detonation
 FORCE = 3.0
-
-class Voxel(object):
-    def __init__(self, pos, v):
-        self.pos = list(pos)
-        self.v = list(v)
+# Sparks per burst on an 8x8x8 cube, more on bigger cubes
+SPARKS = 20
+# Fraction of the previous frame left behind as trails
+TRAIL = math.pow(0.001, DT)
 
 class Pattern(object):
     def init(self):
         self.double_buffer = True
-        self.bits = None
-        self.relaunch = True
+        sz = self.cube.size
+        # Seeded from random, so runs with the same seed match
+        self.rng = numpy.random.RandomState(random.getrandbits(32))
+        self.rockets = particles.ParticleSystem()
+        self.sparks = particles.ParticleSystem(GRAVITY, DRAG)
+        self.frame = numpy.zeros((sz, sz, sz, 3))
+        self.time = 0.0
+        self.salvo()
         return DT
+
     def tick(self):
-        self.cube.clear()
-        if self.bits is not None:
-            self.descend()
-        if self.relaunch:
+        self.time += DT
+        while self.launches and self.launches[0] <= self.time:
+            self.launches.pop(0)
             self.launch()
-        if self.rocket is not None:
-            self.climb()
-        if self.relaunch:
-            self.relaunch = False
-            raise StopIteration
+        (pos, color) = self.rockets.step(DT)
+        for p in pos:
+            self.explode(p)
+        self.sparks.step(DT)
+        frame = self.frame
+        frame *= TRAIL
+        self.rockets.splat(frame)
+        self.sparks.splat(frame)
+        self.cube.set_frame(numpy.minimum(frame, 1.0))
+        # Start the next salvo once the last burst is half faded
+        if self.launches or len(self.rockets) > 0:
+            return
+        if len(self.sparks) > 0 and self.sparks.level.max() >= 0.5:
+            return
+        self.salvo()
+        raise StopIteration
+
+    def salvo(self):
+        """Queue up the launch times for a few rockets"""
+        count = random.randint(1, max(2, self.cube.size // 4))
+        self.launches = sorted(self.time + random.uniform(0.0, 1.0) for i in range(count))
 
-    def plot(self, voxel, color):
-        sz = self.cube.size
-        pos = voxel.pos
-        x = int(pos[0] * sz - 0.001)
-        y = int(pos[1] * sz - 0.001)
-        z = int(pos[2] * sz - 0.001)
-        self.cube.set_pixel((x, y, z), color)
-    def spawn_bit(self, n):
-        d = random.uniform(0.0, math.pi * 2.0)
-        dz= random.uniform(-math.pi / 4, math.pi / 2)
-        v0 = random.uniform(FORCE/2, FORCE)
-        vx = v0 * math.sin(d) * math.cos(dz)
-        vy = v0 * math.cos(d) * math.cos(dz)
-        vz = v0 * math.sin(dz)
-        return Voxel(self.rocket.pos, (vx, vy, vz))
-    def explode(self):
-        self.bit_color = cubehelper.random_color()
-        self.bits = [self.spawn_bit(i) for i in range(0, 20)]
-        self.fade = 1.0
-        self.rocket = None
-    def descend(self):
-        color = cubehelper.mix_color((0.0,0.0,0.0), self.bit_color, self.fade)
-        for bit in self.bits:
-            pos = bit.pos
-            v = bit.v
-            v[0] *= FRICTION
-            v[1] *= FRICTION
-            v[2] *= FRICTION
-            v[2] -= GRAVITY * DT
-            for i in range(0, 3):
-                pos[i] += v[i] * DT
-                if pos[i] < 0.0:
-                    pos[i] = 0.0
-                    v[i] = 0
-                elif pos[i] > 1.0:
-                    pos[i] = 1.0
-            self.plot(bit, color)
-        self.fade -= FADE * DT
-        if self.fade < 0.5 and self.rocket is None:
-            self.relaunch = True
-        if self.fade <= 0:
-            self.bits = None
     def launch(self):
         x = random.uniform(0.25, 0.75)
         y = random.uniform(0.25, 0.75)
-        self.rocket = Voxel((x, y, 0.0), (0,0,0))
-    def climb(self):
-        self.plot(self.rocket, (1.0, 1.0, 1.0))
-        z = self.rocket.pos[2]
-        z += CLIMB * DT
-        if z >= APEX:
-            self.explode()
-        else:
-            self.rocket.pos[2] = z
+        fuse = random.uniform(*APEX) / CLIMB
+        self.rockets.emit((x, y, 0.0), [(0.0, 0.0, CLIMB)], (1.0, 1.0, 1.0), lifetime=fuse)
+
+    def explode(self, pos):
+        n = int(SPARKS * (self.cube.size / 8.0) ** 2)
+        d = self.rng.uniform(0.0, math.pi * 2.0, n)
+        dz = self.rng.uniform(-math.pi / 4, math.pi / 2, n)
+        v0 = self.rng.uniform(FORCE/2, FORCE, n)
+        vel = numpy.empty((n, 3))
+        vel[:, 0] = v0 * numpy.sin(d) * numpy.cos(dz)
+        vel[:, 1] = v0 * numpy.cos(d) * numpy.cos(dz)
+        vel[:, 2] = v0 * numpy.sin(dz)
+        self.sparks.emit(pos, vel, cubehelper.random_color(), fade=FADE)
@@ -1,69 +1,158 @@
-# Fade the whole cube in and out a single color
+# Show a (possibly animated) image on the cube, e.g. --pattern image:anim.gif
 # Copyright (C) Paul Brook <paul@nowt.org>
 # Released under the terms of the GNU General Public License version 3
+#
+# The image is size*size pixels wide and size high: each horizontal slice
+# of the cube is a row of squares, with the top slice at the top.
+#
+# Frames are decoded as they are first shown, and written in cube order
+# to a .npy file in patterns/.cache, which later runs memory map instead
+# of decoding the image again.  The cache is keyed by the image's path,
+# mtime and the cube size.  A partly decoded file left by a process that
+# exited mid-animation is removed the next time the image is opened.
 
-import cubehelper
+import errno
+import hashlib
+import glob
+import os
 import PIL.Image
 import numpy
 
-def load_frames(im):
-    (w, h) = im.size
-    if im.palette is not None:
-        src = im.palette.palette
-        palette = [0]*256
-        for i in range(256):
-            r = ord(src[i * 3])
-            g = ord(src[i * 3 + 1])
-            b = ord(src[i * 3 + 2])
-            palette[i] = (r << 16) | (g << 8) | b
-    else:
-        palette = None
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
+
+replace_file = getattr(os, 'replace', os.rename)
+
+# Index into the flattened image for each voxel, by cube size
+remaps = {}
+
+def remap_index(sz):
+    """Pixel index of voxel [x, y, z] in a (sz, sz*sz) image"""
+    if sz not in remaps:
+        (x, y, z) = numpy.indices((sz, sz, sz))
+        remaps[sz] = (sz - 1 - z) * (sz * sz) + y * sz + x
+    return remaps[sz]
+
+def cache_name(filename, sz):
+    path = os.path.abspath(filename)
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    mtime = int(os.path.getmtime(path) * 1000000)
+    return (os.path.join(CACHE_DIR, 'image-%s' % key), '%d-%d.npy' % (sz, mtime))
+
+def process_exists(pid):
+    if os.name != 'posix':
+        # No cheap way to tell, so assume it is still running
+        return True
     try:
-        while True:
-            ar = numpy.zeros((w, h), 'i')
-            for x in range(0, w):
-                for y in range(0, h):
-                    color = im.getpixel((x, y))
-                    if palette is not None:
-                        color = palette[color]
-                    ar[x, y] = color
-            yield ar
-            im.seek(im.tell() + 1)
-    except EOFError:
-        raise StopIteration
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def remove_stale(prefix):
+    """Remove partly decoded caches of this image left by processes that
+    have gone, e.g. a preroll worker that was terminated mid-animation"""
+    for name in glob.glob(prefix + '-*.npy.tmp-*'):
+        try:
+            pid = int(name.rsplit('-', 1)[1])
+        except ValueError:
+            continue
+        if not process_exists(pid):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+class ImageFrames(object):
+    """The frames of an image as (sz, sz, sz, 3) uint8 arrays, decoded on demand"""
+    def __init__(self, filename, sz):
+        self.size = sz
+        (prefix, suffix) = cache_name(filename, sz)
+        self.cache_file = prefix + '-' + suffix
+        self.prefix = prefix
+        remove_stale(prefix)
+        im = PIL.Image.open(filename)
+        try:
+            self.delay = im.info['duration'] / 1000.0
+        except (KeyError, TypeError):
+            self.delay = 0.0
+        self.im = None
+        if os.path.exists(self.cache_file):
+            im.close()
+            self.frames = numpy.load(self.cache_file, mmap_mode='r')
+            self.decoded = len(self.frames)
+            return
+        if im.size != (sz * sz, sz):
+            raise Exception("Image '%s' is %dx%d, not %dx%d" % ((filename,) + im.size + (sz * sz, sz)))
+        self.im = im
+        self.decoded = 0
+        shape = (getattr(im, 'n_frames', 1), sz, sz, sz, 3)
+        self.temp_file = '%s.tmp-%d' % (self.cache_file, os.getpid())
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            self.frames = numpy.lib.format.open_memmap(self.temp_file, 'w+', numpy.uint8, shape)
+        except (IOError, OSError) as e:
+            print("Not caching image frames: %s" % e)
+            self.temp_file = None
+            self.frames = numpy.empty(shape, numpy.uint8)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, n):
+        while self.decoded <= n:
+            self.decode()
+        return self.frames[n]
+
+    def decode(self):
+        n = self.decoded
+        self.im.seek(n)
+        rgb = numpy.asarray(self.im.convert('RGB')).reshape(-1, 3)
+        self.frames[n] = rgb[remap_index(self.size)]
+        self.decoded = n + 1
+        if self.decoded == len(self.frames):
+            self.im.close()
+            self.im = None
+            self.save()
+
+    def save(self):
+        if self.temp_file is None:
+            return
+        self.frames.flush()
+        # Older versions of this image at this size are no use now
+        for old in glob.glob(self.prefix + '-%d-*.npy' % self.size):
+            os.remove(old)
+        replace_file(self.temp_file, self.cache_file)
+        self.frames = numpy.load(self.cache_file, mmap_mode='r')
+
+    def close(self):
+        """Discard a partly decoded cache file"""
+        if self.im is None:
+            return
+        self.im.close()
+        self.im = None
+        if self.temp_file is not None:
+            del self.frames
+            os.remove(self.temp_file)
 
 class Pattern(object):
     def init(self):
         self.double_buffer = True
         if self.arg is None:
             raise StopIteration
+        if getattr(self, 'frames', None) is not None:
+            self.frames.close()
         try:
-            im = PIL.Image.open(self.arg)
-            sz = self.cube.size
-            if im.size != (sz * sz, sz):
-                raise StopIteration
-            self.frames = list(load_frames(im))
-            self.current_frame = 0
-            try:
-                delay = im.info['duration'] / 100.0
-                if delay < 0.1:
-                    delay = 0.1
-            except:
-                delay = 0.1
+            self.frames = ImageFrames(self.arg, self.cube.size)
         except Exception as e:
             print(e)
+            self.frames = None
             raise StopIteration
-        return delay
-
+        self.current_frame = 0
+        return max(self.frames.delay, 0.1)
 
     def tick(self):
-        sz = self.cube.size
-        data = self.frames[self.current_frame]
-        for y in range(0, sz):
-            for z in range(0, sz):
-                for x in range(0, sz):
-                    color = int(data[x + y * sz, sz - (z + 1)])
-                    self.cube.set_pixel((x, y, z), color)
+        self.cube.set_frame(self.frames[self.current_frame])
         num_frames = len(self.frames)
         if num_frames == 1:
             return
@@ -71,4 +160,3 @@ class Pattern(object):
         if self.current_frame == num_frames:
             self.current_frame = 0
             raise StopIteration
-
@@ -4,28 +4,66 @@ Goal:     Implement 3D version of Conway's Game of Life for LED cubes.
 
 python cube.py -P cuboid:3000 --pattern life
 
+The grid is a numpy volume by default.  Pattern arguments, separated
+by '/', select the original set based engine (sparse), let cells wrap
+around the edges of the cube (wrap, dense engine only), or change the rules (see LifeRule),
+e.g. --pattern life:wrap/B5/S3.4.10-12
+
 Version 3
 """
+import collections
+import functools
 import random
+import numpy
 
 
 class Pattern(object):
 
     def init(self):
         self.double_buffer = True # dosent clear propperly.
+        try:
+            (rule, options) = parse_options(self.arg)
+        except ValueError as e:
+            print(e)
+            raise StopIteration
+        self.sparse = 'sparse' in options
+        if self.sparse:
+            new_state = random_blast
+            next_generation = functools.partial(next_generation_3d, rule=rule)
+        else:
+            new_state = random_blast_dense
+            next_generation = functools.partial(next_generation_dense,
+                                                wrap='wrap' in options,
+                                                rule=rule)
         self.life = CubeLife(size=self.cube.size, 
                              limit=100, 
-                             new_state=random_blast,
-                             next_generation=next_generation_3d)
+                             new_state=new_state,
+                             next_generation=next_generation)
         return 1.0/8 # time between ticks.
 
     def tick(self):
+        if not self.sparse:
+            self.cube.set_frame(self.life.frame())
+            return
         self.cube.clear()
         for (x, y, z), color in self.life.successors():
             self.cube.set_pixel((x, y, z), color)
 
 
 
+def parse_options(arg):
+    """Split a pattern argument into a LifeRule and the other options"""
+    # Empty parts, as in B5//S34, are ignored
+    options = [o for o in arg.split('/') if o] if arg else []
+    rule = LifeRule('/'.join(o for o in options if o[0] in LifeRule.parts))
+    options = [o for o in options if o[0] not in LifeRule.parts]
+    for o in options:
+        if o not in ('sparse', 'wrap'):
+            raise ValueError("Bad life option: '%s'" % o)
+    if 'sparse' in options and 'wrap' in options:
+        raise ValueError("Life option 'wrap' needs the dense engine, not 'sparse'")
+    return (rule, options)
+
 
 class CubeLife(object):
     "Implements interface for generating successor states in conways game of life."
@@ -44,6 +82,12 @@ class CubeLife(object):
             yield ((position, self.color2) if mutation else
                    (position, self.color1))
 
+    def frame(self):
+        "Next generation of a dense state, as a frame of colors."
+        colors = numpy.array([(0, 0, 0), self.color1, self.color2, self.color2],
+                             numpy.uint8)
+        return colors[next(self.__life())]
+
     def __life(self):
         "yield whole generations of life forever."
         while True:
@@ -52,28 +96,40 @@ class CubeLife(object):
             else:
                 self.state = self.next_gen(self.state, self.size)
                 self.count += 1
-                self.patterns.append(self.state)
             yield self.state
 
     def __restart(self):
         "Set initial values for each new game of life"
         self.count = 0
-        self.patterns = []
+        # Hashes of recent generations, to spot any repeat within HISTORY.
+        self.history = collections.deque()
+        self.seen = set()
         self.state = set()
         self.color1, self.color2 = new_colors()
         # Set the inital state from which to spawn Life.
         self.state = self.new_state(self.size)
 
     def __done(self):
-        if len(self.patterns) >= 6:
-            self.patterns.pop(0)
-            # We dont want to be stuck on short repeating patterns forever.
-            # This catches some cases, including solid states but not all.
-            if self.patterns[-3] == self.state:
-                return True
+        # We dont want to be stuck on repeating patterns forever.
+        # A repeat means a still life (or nothing), or an oscillator.
+        h = state_hash(self.state)
+        if h in self.seen:
+            return True
+        if len(self.history) == HISTORY:
+            self.seen.remove(self.history.popleft())
+        self.history.append(h)
+        self.seen.add(h)
         return self.count == self.limit
 
 
+HISTORY = 64
+
+def state_hash(state):
+    if isinstance(state, set):
+        return hash(frozenset(state))
+    return hash(state.tobytes())
+
+
 
 """
 Life implementation in 3d.
@@ -98,24 +154,142 @@ may also be helpful in ensuring a got life / failed-life ratio.
 TODO: choose for good neighbour rules.
 """
 
-def next_generation_3d(state, size=None):
+def next_generation_3d(state, size=None, rule=None):
     """nextGeneration(set: state, size=None): set: {(ints: x, y, z), ...};
     Following the game rules return a successive state from any given state 
     on an infinite or finite plane. Adapted function version for 3d."""
+    rule = rule or DEFAULT_RULE
     new_state = set()
     for cell in state:
         cell_neighbours = neighbours_3d(cell)
-        if len(state & cell_neighbours) in (3, 4): # rule 3 / (1 & 2)
+        if len(state & cell_neighbours) in rule.survive: # rule 3 / (1 & 2)
             new_state.add(cell)
-        elif len(state & cell_neighbours) is 5: # rule 6 they get sick
+        elif len(state & cell_neighbours) in rule.mutate: # rule 6 they get sick
             c, _ = cell
             new_state.add((c, True))
         for cn in cell_neighbours: # rule 4
-            if len(state & neighbours_3d(cn)) is 5: 
+            if len(state & neighbours_3d(cn)) in rule.birth: 
                 new_state.add(cn)
     return (new_state if not size else constrain(new_state, size))
 
 
+"""
+Dense implementation of the same rules.
+
+The state is a uint8 volume indexed [x, y, z], with the HEALTHY bit set
+for a live cell and the SICK bit for a mutated one.  As with the sets
+above, healthy and sick cells only count neighbours of their own kind,
+and a cell can be both.  The two neighbour counts are kept in the low
+and high bytes of one uint16 volume, so a single box sum counts both,
+and the next state is looked up in the rule's table.
+"""
+
+HEALTHY = 1
+SICK = 2
+
+
+class LifeRule(object):
+    """Life rules, as a string like B5/S34/M5 (the default).
+
+    B: neighbour counts on which a cell is born.
+    S: counts on which a live cell survives.
+    M: counts on which a healthy cell that does not survive turns sick.
+       Sick cells survive on these too.
+    Healthy and sick cells follow the rules separately, each counting
+    only neighbours of their own kind.  Counts are single digits run
+    together, or separated by '.' (needed above 9) with '-' for ranges,
+    e.g. S3.4.10-12.  Parts that are left out keep their default.
+    B0 is not allowed: the set based engine only looks at cells next to
+    live ones, so it cannot give birth in empty space."""
+
+    parts = 'BSM'
+
+    def __init__(self, text=''):
+        counts = {'B': [5], 'S': [3, 4], 'M': [5]}
+        for part in text.split('/') if text else []:
+            if part == '':
+                continue
+            if part[0] not in self.parts:
+                raise ValueError("Bad life rule: '%s'" % part)
+            counts[part[0]] = parse_counts(part[1:])
+        if 0 in counts['B']:
+            raise ValueError("Bad life rule: births on 0 neighbours are not supported")
+        self.birth = frozenset(counts['B'])
+        self.survive = frozenset(counts['S'])
+        self.mutate = frozenset(counts['M'])
+        self.table = self.compile()
+
+    def __str__(self):
+        return '/'.join(p + '.'.join(str(n) for n in sorted(c))
+                        for p, c in zip(self.parts,
+                                        (self.birth, self.survive, self.mutate)))
+
+    def compile(self):
+        """Lookup table of the next state, indexed by
+        state * 27 * 27 + healthy neighbours * 27 + sick neighbours."""
+        state, nh, ns = numpy.indices((4, 27, 27))
+        healthy = (state & HEALTHY) != 0
+        sick = (state & SICK) != 0
+        birth = numpy.array([n in self.birth for n in range(27)])
+        survive = numpy.array([n in self.survive for n in range(27)])
+        mutate = numpy.array([n in self.mutate for n in range(27)])
+        new_healthy = (healthy & survive[nh]) | birth[nh]
+        new_sick = ((sick & (survive[ns] | mutate[ns])) | birth[ns] |
+                    (healthy & ~survive[nh] & mutate[nh]))
+        table = new_healthy.astype(numpy.uint8) | (new_sick.astype(numpy.uint8) << 1)
+        return table.ravel()
+
+
+def parse_counts(text):
+    counts = []
+    if '.' not in text and '-' not in text:
+        items = list(text)
+    else:
+        items = text.split('.')
+    for item in items:
+        try:
+            if '-' in item:
+                lo, hi = item.split('-')
+                counts += range(int(lo), int(hi) + 1)
+            else:
+                counts.append(int(item))
+        except ValueError:
+            raise ValueError("Bad life rule counts: '%s'" % text)
+    if any(n < 0 or n > 26 for n in counts):
+        raise ValueError("Bad life rule counts: '%s'" % text)
+    return counts
+
+
+DEFAULT_RULE = LifeRule()
+
+
+def next_generation_dense(state, size=None, wrap=False, rule=None):
+    """next_generation_dense(array: state, size=None, wrap=False): array;
+    Same rules as next_generation_3d. Cells beyond the edge are dead,
+    as with constrain, unless wrap joins opposite faces together."""
+    rule = rule or DEFAULT_RULE
+    layers = (state & HEALTHY).astype(numpy.uint16) | ((state & SICK).astype(numpy.uint16) << 7)
+    counts = box_sum(layers, wrap) - layers
+    index = state * numpy.uint16(27 * 27) + (counts & 0xff) * numpy.uint16(27) + (counts >> 8)
+    return rule.table[index]
+
+
+def box_sum(a, wrap=False):
+    "Sum of each cell and its 26 neighbours, one axis at a time."
+    a = numpy.pad(a, 1, 'wrap' if wrap else 'constant')
+    a = a[:-2] + a[1:-1] + a[2:]
+    a = a[:, :-2] + a[:, 1:-1] + a[:, 2:]
+    return a[:, :, :-2] + a[:, :, 1:-1] + a[:, :, 2:]
+
+
+def to_dense(state, size):
+    "Convert a set state to a dense one."
+    grid = numpy.zeros((size, size, size), numpy.uint8)
+    for position, mutation in constrain(state, size):
+        grid[position] |= SICK if mutation else HEALTHY
+    return grid
+
+
 def neighbours_3d(cell):
     """neighbours(tuple: cell): set: {(ints: x, y, z), ...};
     returns a set of co-ordinates +/- 1 from a given position."""
@@ -152,6 +326,10 @@ def random_blast(size):
     return (bundle | scatter)
 
 
+def random_blast_dense(size):
+    return to_dense(random_blast(size), size)
+
+
 # Color Utilies:
 
 def new_colors():
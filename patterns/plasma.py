@@ -3,8 +3,8 @@
 # Released under the terms of the GNU General Public License version 3
 
 import random
-import cubehelper
 import math
+import numpy
 
 DT = 0.05
 
@@ -23,24 +23,26 @@ def color_from_val(val):
         r = 0;
     return (r, g, b)
 
+# The static part of the plasma, which only depends on the cube size
+fields = {}
+
+def plasma_field(sz):
+    if sz not in fields:
+        scale = math.pi * 2.0 / float(sz)
+        offset = 0.5
+        c = numpy.cos((numpy.arange(sz) + offset) * scale)
+        # Indexed [x, y, z], with u, v and w along x, y and z
+        fields[sz] = (c[:, None, None] + c[None, :, None] + c[None, None, :] + 3.0) / 6.0
+    return fields[sz]
+
 class Pattern(object):
     def init(self):
         self.offset = 0.0
+        self.field = plasma_field(self.cube.size)
         return DT
 
     def tick(self):
         self.offset -= DT / 1.0
         if self.offset < 0:
             self.offset += 1.0
-        sz = self.cube.size
-        scale = math.pi * 2.0 / float(sz)
-        offset = 0.5
-        for y in range(0, sz):
-            for z in range(0, sz):
-                for x in range(0, sz):
-                    u = math.cos((x + offset) * scale)
-                    v = math.cos((y + offset) * scale)
-                    w = math.cos((z + offset) * scale)
-                    e = (u + v + w + 3.0) / 6.0
-                    color = self.cube.plasma(self.offset + e)
-                    self.cube.set_pixel((x, y, z), color)
+        self.cube.set_frame(self.cube.plasma.to_int(self.offset + self.field))
@@ -1,48 +1,88 @@
 # Multicolored raidrops falling from the sky
 # Copyright (C) Paul Brook <paul@nowt.org>
 # Released under the terms of the GNU General Public License version 3
+#
+# Arguments, separated by '/': the number of new drops per tick for each
+# 8x8 patch of sky (default 1), and 'nosplash' to turn off the splashes
+# drops make when they land, e.g. --pattern rain:2.5/nosplash
 
 import random
-import math
-import cubehelper
+import numpy
 
-class Drop(object):
-    def __init__(self, cube, x, y):
-        self.cube = cube
-        self.x = x
-        self.y = y
-        self.z = -1
-    def reset(self):
-        self.z = self.cube.size
-        self.speed = random.uniform(1.0, 0.25)
-        self.color = cubehelper.random_color()
-    def tick(self):
-        self.z -= self.speed
-        z0 = int(math.floor(self.z))
-        if z0 < self.cube.size - 1:
-            self.cube.set_pixel((self.x , self.y, z0 + 1), (0,0,0))
-        if z0 >= 0:
-            self.cube.set_pixel((self.x , self.y, z0), self.color)
+DT = 0.1
+DENSITY = 1.0
+# How much of a splash is left after each tick, until it drops below SPLASH_MIN
+SPLASH_FADE = 0.5
+SPLASH_MIN = 0.1
+# Brightness of the splash around where a drop lands
+SPLASH_LEVEL = 0.5
 
 class Pattern(object):
     def init(self):
-        self.drops = []
-        self.unused = []
-        for x in range(0, self.cube.size):
-            for y in range(0, self.cube.size):
-                self.unused.append(Drop(self.cube, x, y))
-        return 0.1
+        options = self.arg.split('/') if self.arg else []
+        self.splash = 'nosplash' not in options
+        options = [o for o in options if o != 'nosplash']
+        try:
+            self.density = float(options[0]) if options else DENSITY
+        except ValueError:
+            print("Bad rain density: '%s'" % options[0])
+            raise StopIteration
+        sz = self.cube.size
+        # Seeded from random, so runs with the same seed match
+        self.rng = numpy.random.RandomState(random.getrandbits(32))
+        # One drop per column, indexed [x, y]
+        self.active = numpy.zeros((sz, sz), bool)
+        self.z = numpy.zeros((sz, sz))
+        self.speed = numpy.zeros((sz, sz))
+        self.color = numpy.zeros((sz, sz, 3))
+        # Splashes, indexed by where the drop landed
+        self.splash_level = numpy.zeros((sz, sz))
+        self.splash_color = numpy.zeros((sz, sz, 3))
+        self.due = 0.0
+        self.frame = numpy.zeros((sz, sz, sz, 3))
+        return DT
+
     def spawn(self):
-        d = self.unused.pop(random.randrange(len(self.unused)))
-        d.reset()
-        self.drops.append(d)
+        sz = self.cube.size
+        self.due += self.density * sz * sz / 64.0
+        idle = numpy.flatnonzero(~self.active)
+        n = min(int(self.due), len(idle))
+        self.due -= int(self.due)
+        if n == 0:
+            return
+        cols = numpy.unravel_index(self.rng.choice(idle, n, replace=False), (sz, sz))
+        self.active[cols] = True
+        self.z[cols] = sz
+        self.speed[cols] = self.rng.uniform(0.25, 1.0, n)
+        # Any mix of full red, green and blue except black, as random_color
+        bits = self.rng.randint(1, 8, n)
+        self.color[cols] = (bits[:, numpy.newaxis] >> numpy.arange(3)) & 1
+
     def tick(self):
         self.spawn()
-        drops = self.drops;
-        self.drops = []
-        for d in drops:
-            d.tick()
-            if d.z < 0:
-                self.unused.append(d)
-            else:
-                self.drops.append(d)
+        self.z -= self.speed * self.active
+        landed = self.active & (self.z < 0)
+        self.active &= ~landed
+        frame = self.frame
+        frame.fill(0.0)
+        (x, y) = numpy.nonzero(self.active)
+        frame[x, y, numpy.floor(self.z[x, y]).astype(numpy.intp)] = self.color[x, y]
+        if self.splash:
+            self.splash_level *= SPLASH_FADE
+            self.splash_level[self.splash_level < SPLASH_MIN] = 0.0
+            self.splash_level[landed] = 1.0
+            self.splash_color[landed] = self.color[landed]
+            self.draw_splashes(frame)
+        self.cube.set_frame(frame)
+
+    def draw_splashes(self, frame):
+        """Light the floor around each splash, as a ring of the drop's color"""
+        sz = self.cube.size
+        light = numpy.pad(self.splash_color * self.splash_level[..., numpy.newaxis],
+                          ((1, 1), (1, 1), (0, 0)), 'constant')
+        ring = -light[1:-1, 1:-1]
+        for dx in range(3):
+            for dy in range(3):
+                ring = ring + light[dx:dx + sz, dy:dy + sz]
+        floor = frame[:, :, 0]
+        numpy.maximum(floor, numpy.minimum(ring * SPLASH_LEVEL, 1.0), out=floor)
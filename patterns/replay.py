@@ -0,0 +1,36 @@
+# Play back a recording made with --record
+# Released under the terms of the GNU General Public License version 3
+
+import framefile
+import scheduler
+
+class Pattern(object):
+    def init(self):
+        self.double_buffer = True
+        if self.arg is None:
+            raise StopIteration
+        try:
+            self.reader = framefile.FrameReader(self.arg)
+        except Exception as e:
+            print(e)
+            raise StopIteration
+        if self.reader.size != self.cube.size or len(self.reader) == 0:
+            raise StopIteration
+        self.start = scheduler.monotonic() - self.reader.timestamps[0]
+        self.current_frame = None
+        # Tick often enough to show every frame close to its recorded time
+        gaps = [t for t in self.reader.timestamps[1:] - self.reader.timestamps[:-1] if t > 0]
+        if len(gaps) == 0:
+            return 0.1
+        return max(min(gaps), 0.01)
+
+    def tick(self):
+        reader = self.reader
+        n = reader.find(scheduler.monotonic() - self.start)
+        if n != self.current_frame:
+            self.current_frame = n
+            self.cube.set_frame(reader.frame(n))
+        if n == len(reader) - 1:
+            self.start = scheduler.monotonic() - reader.timestamps[0]
+            self.current_frame = None
+            raise StopIteration
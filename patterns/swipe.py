@@ -3,6 +3,7 @@
 # Released under the terms of the GNU General Public License version 3
 
 import cubehelper
+import numpy
 
 class Pattern(object):
     def init(self):
@@ -12,24 +13,12 @@ class Pattern(object):
         return 1.0 / self.cube.size
     def tick(self):
         self.offset += 1
-        p0 = self.phase
-        p1 = (p0 + 1) % 3
-        p2 = (p1 + 1) % 3
-        pos = [0]*3
-        off = [0]*3
-        on = [0]*3
-        on[p0] = 255
-        for i in range(0, self.cube.size):
-            if i == self.cube.size - (abs(self.offset) + 1):
-                color = self.color
-            else:
-                color = off
-            pos[p0] = i
-            for j in range(0, self.cube.size):
-                pos[p1] = j
-                for k in range(0, self.cube.size):
-                    pos[p2] = k
-                    self.cube.set_pixel(pos, color)
+        sz = self.cube.size
+        frame = numpy.zeros((sz, sz, sz, 3))
+        plane = [slice(None)] * 3
+        plane[self.phase] = sz - (abs(self.offset) + 1)
+        frame[tuple(plane)] = self.color
+        self.cube.set_frame(frame)
         if self.offset == self.cube.size - 1:
             self.color = cubehelper.random_color()
             self.offset = 1 - self.cube.size
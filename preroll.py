@@ -0,0 +1,164 @@
+# Run patterns in worker processes, ahead of when they are displayed
+# Released under the terms of the GNU General Public License version 3
+#
+# Each pattern is initialized and ticked in its own process, drawing into
+# an in-memory cube.  Frames are passed back through a ring buffer in
+# shared memory.  The worker for the next pattern is started as soon as
+# the current one starts playing, so its init and first frames are ready
+# by the time it is needed.
+
+import argparse
+import multiprocessing
+import numpy
+import memcube
+
+try:
+    mp = multiprocessing.get_context('fork')
+except AttributeError:
+    mp = multiprocessing
+
+# Per frame flags
+FRAME = 0
+STOP = 1 # tick raised StopIteration
+END = 2 # the pattern failed or did not start
+
+POLL = 0.2
+
+class FrameRing(object):
+    """Frames passed from one producer to one consumer through shared memory"""
+    def __init__(self, size, slots):
+        self.slots = slots
+        self.shape = (size, size, size, 3)
+        self.buf = mp.RawArray('B', slots * size * size * size * 3)
+        self.frames = numpy.frombuffer(self.buf, numpy.uint8).reshape((slots,) + self.shape)
+        self.flags = mp.RawArray('b', slots)
+        self.free = mp.Semaphore(slots)
+        self.ready = mp.Semaphore(0)
+        self.head = 0
+        self.tail = 0
+
+    def put(self, frame, flag, stop):
+        while not self.free.acquire(True, POLL):
+            if stop.is_set():
+                return False
+        n = self.head
+        if frame is not None:
+            self.frames[n] = frame
+        self.flags[n] = flag
+        self.head = (n + 1) % self.slots
+        self.ready.release()
+        return True
+
+    def get(self, worker):
+        """Return (frame, flag) for the next frame, or None if the worker died"""
+        while not self.ready.acquire(True, POLL):
+            if not worker.is_alive():
+                return None
+        n = self.tail
+        self.tail = (n + 1) % self.slots
+        return (self.frames[n], self.flags[n])
+
+    def release(self):
+        self.free.release()
+
+def run_worker(pattern, cube, ring, interval, double_buffer, started, stop):
+    try:
+        try:
+            interval.value = pattern.init()
+        except StopIteration:
+            interval.value = -1.0
+            return
+        finally:
+            double_buffer.value = getattr(pattern, 'double_buffer', False)
+            started.set()
+        if not double_buffer.value:
+            cube.single_buffer()
+        cube.clear()
+        while not stop.is_set():
+            try:
+                pattern.tick()
+                flag = FRAME
+            except StopIteration:
+                flag = STOP
+            if not ring.put(cube.pixels, flag, stop):
+                break
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(e)
+        print("Pattern '%s' failed" % pattern.name)
+        ring.put(None, END, stop)
+
+class PrerolledPattern(object):
+    """Plays back the frames of a pattern running in a worker process"""
+    def __init__(self, pattern, cube, slots):
+        self.name = pattern.name
+        self.cube = cube
+        self.ring = FrameRing(cube.size, slots)
+        self.interval = mp.Value('d', -1.0)
+        self.db = mp.Value('b', 0)
+        self.started = mp.Event()
+        self.stop = mp.Event()
+        capture = memcube.Cube(argparse.Namespace(size=cube.size))
+        capture.color = cube.color
+        capture.plasma = cube.plasma
+        pattern.cube = capture
+        self.worker = mp.Process(target=run_worker, args=(pattern, capture,
+            self.ring, self.interval, self.db, self.started, self.stop))
+        self.worker.daemon = True
+        self.worker.start()
+        pattern.cube = cube
+        self.ended = False
+
+    def init(self):
+        while not self.started.wait(POLL):
+            if not self.worker.is_alive():
+                raise StopIteration
+        if self.interval.value < 0:
+            raise StopIteration
+        self.double_buffer = bool(self.db.value)
+        return self.interval.value
+
+    def tick(self):
+        if self.ended:
+            raise StopIteration
+        r = self.ring.get(self.worker)
+        if r is None:
+            self.ended = True
+            raise StopIteration
+        (frame, flag) = r
+        if flag == END:
+            self.ended = True
+        else:
+            self.cube.set_frame(frame)
+        self.ring.release()
+        if flag != FRAME:
+            raise StopIteration
+
+    def finish(self):
+        self.stop.set()
+        self.worker.join(1.0)
+        if self.worker.is_alive():
+            self.worker.terminate()
+
+def prerolled(patterns, cube, slots):
+    """Wraps a pattern sequence, starting each pattern before it is needed"""
+    it = iter(patterns)
+    try:
+        following = PrerolledPattern(next(it), cube, slots)
+    except StopIteration:
+        return
+    while following is not None:
+        current = following
+        try:
+            following = PrerolledPattern(next(it), cube, slots)
+        except StopIteration:
+            following = None
+        try:
+            yield current
+        except GeneratorExit:
+            if following is not None:
+                following.finish()
+            raise
+        finally:
+            current.finish()
@@ -0,0 +1,51 @@
+# Frame pacing for LED cube patterns
+# Released under the terms of the GNU General Public License version 3
+
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+class FrameScheduler(object):
+    """Paces frames at a fixed interval on a monotonic clock.
+
+    Frame n is due at start + n * interval, so a slow frame does not push
+    back the ones after it.  When a whole frame slot has been missed it is
+    either skipped, or with catchup set run back to back."""
+    def __init__(self, interval, catchup=False, sleep=time.sleep):
+        self.interval = interval
+        self.catchup = catchup
+        self.sleep = sleep
+        self.start = monotonic()
+        self.frame = 1
+        self.reset_stats()
+
+    def now(self):
+        return monotonic()
+
+    def reset_stats(self):
+        self.frames = 0
+        self.late = 0
+        self.dropped = 0
+        self.max_lateness = 0.0
+
+    def wait(self):
+        """Wait for the next frame to become due, and return how late it is"""
+        due = self.start + self.frame * self.interval
+        now = monotonic()
+        self.frames += 1
+        if now < due:
+            self.sleep(due - now)
+            lateness = 0.0
+        else:
+            lateness = now - due
+            self.late += 1
+            self.max_lateness = max(self.max_lateness, lateness)
+            if not self.catchup and self.interval > 0:
+                missed = int(lateness / self.interval)
+                self.frame += missed
+                self.dropped += missed
+        self.frame += 1
+        return lateness
@@ -2,22 +2,179 @@
 # Copyright (C) Paul Brook <paul@nowt.org>
 # Released under the terms of the GNU General Public License version 3
 
+import argparse
 import numpy
 import cubehelper
+import itertools
 import socket
+import struct
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-BUFFER_SIZE = 128
+CONNECT_TIMEOUT = 2.0
+SEND_TIMEOUT = 0.5
+RECONNECT_MIN = 0.25
+RECONNECT_MAX = 8.0
 
 class TCPWriter(object):
+    """Sends to a network cube, reconnecting in the background if the link fails.
+
+    Writes made while disconnected are dropped rather than waiting."""
     def __init__(self, addr):
         (host, port) = addr.split(':')
         port = int(port)
         if host == "":
             host = "localhost"
-        self.sock = socket.create_connection((host, int(port)))
-        #self.sock.recv(4)
+        self.addr = (host, port)
+        self.sock = None
+        self.reconnects = 0
+        self.dropped = 0
+        self.lost = False
+        try:
+            self._connect()
+        except socket.error as e:
+            print("Connecting to %s:%d failed: %s" % (host, port, e))
+            self._reconnect()
+
+    def _connect(self):
+        sock = socket.create_connection(self.addr, CONNECT_TIMEOUT)
+        # Frames are sent in one go, so do not wait to batch them up
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(SEND_TIMEOUT)
+        self.sock = sock
+
+    def _reconnect(self):
+        self.lost = True
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        thread = threading.Thread(target=self._reconnect_loop)
+        thread.daemon = True
+        thread.start()
+
+    def _reconnect_loop(self):
+        delay = RECONNECT_MIN
+        while True:
+            time.sleep(delay)
+            try:
+                self._connect()
+                self.reconnects += 1
+                return
+            except socket.error:
+                delay = min(delay * 2, RECONNECT_MAX)
+
+    def sync(self):
+        """Returns False if data written since the last call may have been lost"""
+        ok = not self.lost
+        self.lost = False
+        return ok
+
     def write(self, b):
-        self.sock.sendall(b)
+        sock = self.sock
+        if sock is None:
+            self.dropped += 1
+            self.lost = True
+            return
+        try:
+            sock.sendall(b)
+        except socket.error as e:
+            print("Connection to %s:%d lost: %s" % (self.addr[0], self.addr[1], e))
+            self.dropped += 1
+            self._reconnect()
+
+    def close(self):
+        if self.reconnects > 0 or self.dropped > 0:
+            print("%d reconnects, %d writes dropped" % (self.reconnects, self.dropped))
+        if self.sock is not None:
+            self.sock.close()
+
+def split_options(port):
+    """Split 'port?a=1&b' into ('port', {'a':'1', 'b':''})"""
+    if '?' not in port:
+        return (port, {})
+    (port, opts) = port.split('?', 1)
+    options = {}
+    for opt in opts.split('&'):
+        if '=' in opt:
+            (key, val) = opt.split('=', 1)
+        else:
+            (key, val) = (opt, '')
+        options[key] = val
+    return (port, options)
+
+# One datagram per frame: header, then either every voxel's RGB in
+# (x, y, z) order, or with UDP_DELTA a (voxel index, RGB) record for
+# each voxel changed since frame base_seq.
+UDP_HEADER = struct.Struct('>4sIIBBB3BH')
+UDP_MAGIC = b'CUBE'
+UDP_DELTA = 1
+UDP_BRIGHTNESS = 2
+UDP_DELTA_TYPE = numpy.dtype([('index', '>u2'), ('rgb', 'u1', (3,))])
+
+class UDPWriter(object):
+    """Sends each frame as a single self-contained datagram.
+
+    Options: 'delta' sends only changed voxels, relative to the previous
+    frame, with a full frame every 'keyframe' frames (default 16)."""
+    frame_writer = True
+
+    def __init__(self, addr):
+        (addr, options) = split_options(addr)
+        (host, port) = addr.rsplit(':', 1)
+        if host == "":
+            host = "localhost"
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, int(port)))
+        self.sock.setblocking(False)
+        self.delta = 'delta' in options
+        self.keyframe = int(options.get('keyframe', 16))
+        self.seq = 0
+        self.previous = None
+        self.dropped = 0
+
+    def send_frame(self, rgb, size, page, brightness):
+        self.seq = (self.seq + 1) & 0xffffffff
+        base = 0
+        flags = 0
+        count = 0
+        payload = None
+        if self.delta and self.previous is not None and self.seq % self.keyframe != 0:
+            changed = numpy.flatnonzero((rgb != self.previous).any(axis=1))
+            if len(changed) * UDP_DELTA_TYPE.itemsize < rgb.size:
+                records = numpy.zeros(len(changed), UDP_DELTA_TYPE)
+                records['index'] = changed
+                records['rgb'] = rgb[changed]
+                payload = records.tobytes()
+                count = len(changed)
+                flags |= UDP_DELTA
+                base = (self.seq - 1) & 0xffffffff
+        if payload is None:
+            payload = rgb.tobytes()
+        if brightness is None:
+            brightness = (0, 0, 0)
+        else:
+            flags |= UDP_BRIGHTNESS
+        header = UDP_HEADER.pack(UDP_MAGIC, self.seq, base, size, page, flags,
+                brightness[0], brightness[1], brightness[2], count)
+        self.previous = rgb.copy()
+        try:
+            self.sock.send(header + payload)
+        except socket.error:
+            # A late frame is worth nothing, so do not wait to send it
+            self.dropped += 1
+
+    def write(self, b):
+        # Frames are sent whole, there is no command stream
+        pass
+
+    def close(self):
+        if self.dropped > 0:
+            print("%d frames dropped" % self.dropped)
+        self.sock.close()
 
 def FileWriter(name):
     return open(name, "wb")
@@ -28,9 +185,26 @@ def SerialWriter(port):
     ser.read(4)
     return ser
 
+SPI_BUFSIZ_PARAM = "/sys/module/spidev/parameters/bufsiz"
+SPI_DEFAULT_BUFSIZ = 4096
+SPI_DEFAULT_SPEED = 2000000
+
+def spi_bufsiz():
+    """The largest single transfer the spidev driver accepts"""
+    try:
+        with open(SPI_BUFSIZ_PARAM) as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return SPI_DEFAULT_BUFSIZ
+
 class SPIWriter(object):
+    """Writes to a cube on an SPI bus, e.g. spi:0.1?speed=8000000&chunk=4096
+
+    Options: 'speed' is the clock rate in Hz, and 'chunk' limits the size
+    of each transfer, which is never more than the kernel allows."""
     def __init__(self, port):
         import spidev
+        (port, options) = split_options(port)
         if port[:11] == '/dev/spidev':
             port = port[11:]
         bus = None
@@ -47,15 +221,96 @@ class SPIWriter(object):
                 bus = int(port)
             dev = 0
         spi = spidev.SpiDev(bus, dev)
-        spi.max_speed_hz = 2000000
+        spi.max_speed_hz = int(options.get('speed', SPI_DEFAULT_SPEED))
         spi.mode = 3
         spi.lsbfirst = False
         spi.cshigh = False
         spi.bits_per_word = 8
         self.spi = spi
+        self.chunk = spi_bufsiz()
+        if 'chunk' in options:
+            self.chunk = min(int(options['chunk']), self.chunk)
+        # writebytes2 takes any buffer, where writebytes needs a list of ints
+        self.zero_copy = hasattr(spi, 'writebytes2')
+
+    def write(self, b):
+        b = numpy.ascontiguousarray(b, numpy.uint8)
+        for pos in range(0, len(b), self.chunk):
+            if self.zero_copy:
+                self.spi.writebytes2(b[pos:pos + self.chunk])
+            else:
+                self.spi.writebytes(b[pos:pos + self.chunk].tolist())
+
+class ThreadedWriter(object):
+    """Hands data to another writer from a background thread.
+
+    Up to depth writes are queued.  When the queue is full, write either
+    blocks or, with drop set, discards everything still queued."""
+    def __init__(self, writer, depth, drop=False):
+        self.writer = writer
+        self.queue = queue.Queue(depth)
+        self.drop = drop
+        self.dropped = 0
+        self.lost = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            b = self.queue.get()
+            if b is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.writer.write(b)
+            except Exception as e:
+                self.error = e
+
+    def _discard(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.dropped += 1
+            self.lost = True
+
+    def sync(self):
+        """Returns False if data written since the last call may have been lost"""
+        if self.drop and self.queue.full():
+            # Make room now, so the next frame can be sent in full
+            self._discard()
+        ok = writer_sync(self.writer) and not self.lost
+        self.lost = False
+        return ok
+
     def write(self, b):
-        self.spi.writebytes(b)
+        if self.error is not None:
+            raise self.error
+        if self.drop:
+            try:
+                self.queue.put_nowait(b)
+            except queue.Full:
+                self._discard()
+                self.queue.put_nowait(b)
+        else:
+            self.queue.put(b)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if hasattr(self.writer, 'close'):
+            self.writer.close()
 
+def writer_sync(writer):
+    try:
+        fn = writer.sync
+    except AttributeError:
+        return True
+    return fn()
 
 def minicube_map(xyz):
     return (0, xyz[0] + xyz[1] * 4 + xyz[2] * 16)
@@ -67,9 +322,75 @@ def maxicube_map(xyz):
     pos = x + ((y ^ 1) % 2) * 8 + (z ^ 1) * 16
     return (board, pos)
 
-class Cube(object):
+def command(cmd, d0, d1, d2):
+    return numpy.array((cmd, d0, d1, d2), numpy.uint8)
+
+BUS_RESET = numpy.array((0xff, 0xff, 0xff, 0xff, 0xe0, 0xf0, 0xf1, 0xf2), numpy.uint8)
+
+def select_command(board):
+    return numpy.concatenate((BUS_RESET, command(0xe1, board, 0, 0)))
+
+CLEAR_COMMANDS = numpy.zeros((128, 4), numpy.uint8)
+CLEAR_COMMANDS[:, 0] = numpy.arange(128)
+CLEAR_COMMANDS = numpy.concatenate((select_command(0xff), CLEAR_COMMANDS.ravel()))
+
+class FrameEncoder(object):
+    """Compiles whole frames into the serial command stream.
+
+    The (board, offset) of every voxel is looked up once.  Commands are
+    grouped by board, so each board is selected exactly once per frame."""
+    def __init__(self, size, mapfn):
+        n = size * size * size
+        board = numpy.zeros(n, numpy.int32)
+        offset = numpy.zeros(n, numpy.int32)
+        for (index, xyz) in enumerate(itertools.product(range(size), repeat=3)):
+            (board[index], offset[index]) = mapfn(xyz)
+        order = numpy.lexsort((offset, board))
+        parts = []
+        rows = []
+        nrows = 0
+        self.boards = []
+        for b in numpy.unique(board):
+            index = order[board[order] == b]
+            header = select_command(b).reshape(-1, 4)
+            cmds = numpy.zeros((len(index), 4), numpy.uint8)
+            cmds[:, 0] = offset[index]
+            parts += [header, cmds]
+            rows.append(numpy.arange(len(index)) + nrows + len(header))
+            nrows += len(header) + len(index)
+            self.boards.append((int(b), index, cmds[:, 0].copy()))
+        # Pixel command rows in the template, and the voxel each one shows
+        self.template = numpy.concatenate(parts)
+        self.rows = numpy.concatenate(rows)
+        self.index = numpy.concatenate([index for (b, index, offsets) in self.boards])
+        self.last_board = self.boards[-1][0]
+        self.zero = numpy.zeros((n, 3), numpy.uint8)
+
+    def encode(self, rgb, previous=None):
+        """Return the command stream for a (size^3, 3) uint8 array.
+
+        If previous is given, only voxels that differ from it are sent."""
+        if previous is None:
+            out = self.template.copy()
+            out[self.rows, 1:] = rgb[self.index]
+            return out.ravel()
+        changed = (rgb != previous).any(axis=1)
+        parts = []
+        for (board, index, offsets) in self.boards:
+            mask = changed[index]
+            if not mask.any():
+                continue
+            cmds = numpy.empty((numpy.count_nonzero(mask), 4), numpy.uint8)
+            cmds[:, 0] = offsets[mask]
+            cmds[:, 1:] = rgb[index[mask]]
+            parts += [select_command(board), cmds.ravel()]
+        if len(parts) == 0:
+            return numpy.zeros(0, numpy.uint8)
+        return numpy.concatenate(parts)
+
+class Cube(cubehelper.PixelBuffer):
     def __init__(self, args):
-        writers = {'tcp':TCPWriter, 'file':FileWriter, 'serial':SerialWriter, 'spi':SPIWriter}
+        writers = {'tcp':TCPWriter, 'udp':UDPWriter, 'file':FileWriter, 'serial':SerialWriter, 'spi':SPIWriter}
         if ':' in args.port:
             (proto, port) = args.port.split(':', 1)
         else:
@@ -88,10 +409,15 @@ class Cube(object):
             else:
                 proto = 'file'
         self.ser = writers[proto](port)
+        self.frame_writer = getattr(self.ser, 'frame_writer', False)
+        depth = getattr(args, 'queue', 0)
+        if depth > 0 and not self.frame_writer:
+            self.ser = ThreadedWriter(self.ser, depth, getattr(args, 'drop', False))
         self.current_board = None
         self.size = args.size
         self.write_page = 0
         self.display_page = 0
+        self.double_buffered = False
         if self.size == 4:
             self.mapfn = minicube_map
             self.color = False
@@ -100,56 +426,67 @@ class Cube(object):
             self.color = True
         else:
             raise Exception("Bad cube size: %d" % args.size)
-        self.buffer_len = 0
-        if BUFFER_SIZE > 0:
-            self.cmd_buffer = numpy.zeros(BUFFER_SIZE, numpy.uint8)
+        self.encoder = FrameEncoder(self.size, self.mapfn)
+        self.pixels = numpy.zeros((self.size, self.size, self.size, 3), numpy.uint8)
+        # What we last wrote to each hardware page, None if unknown
+        self.shadow = [None, None]
+        self.brightness = None
+        # Commands are queued here, and sent to the cube in a single write
+        self.cmd_buffer = []
 
     def _flush_data(self):
-        n = self.buffer_len
-        self.buffer_len = 0
-        if n == 0 or BUFFER_SIZE == 0:
+        buf = self.cmd_buffer
+        if len(buf) == 0:
+            return
+        self.cmd_buffer = []
+        if self.frame_writer:
             return
-        if n == BUFFER_SIZE:
-            self.ser.write(self.cmd_buffer)
+        if len(buf) == 1:
+            self.ser.write(buf[0])
         else:
-            self.ser.write(self.cmd_buffer[:n])
+            self.ser.write(numpy.concatenate(buf))
 
     def do_cmd(self, cmd, d0, d1, d2):
-        if BUFFER_SIZE > 0:
-            pos = self.buffer_len
-            buf = self.cmd_buffer
-            buf[pos] = cmd
-            buf[pos + 1] = d0
-            buf[pos + 2] = d1
-            buf[pos + 3] = d2
-            try:
-                self.buffer_len += 4
-                if self.buffer_len == BUFFER_SIZE:
-                    self._flush_data()
-            except:
-                self.buffer_len = 0
-                raise
-        else:
-            self.ser.write(bytearray((cmd, d0, d1, d2)))
+        self.cmd_buffer.append(command(cmd, d0, d1, d2))
 
     def bus_reset(self):
-        self.do_cmd(0xff, 0xff, 0xff, 0xff)
-        self.do_cmd(0xe0, 0xf0, 0xf1, 0xf2)
+        self.cmd_buffer.append(BUS_RESET)
         self.current_board = None
 
     def select_board(self, board = 0xff):
-        self.bus_reset()
-        self.do_cmd(0xe1, board, 0, 0)
+        self.cmd_buffer.append(select_command(board))
         self.current_board = board
 
     def set_brightness(self, rgb):
+        self.brightness = rgb
         self.select_board()
         self.do_cmd(0xc0, rgb[0], rgb[1], rgb[2])
 
-    def clear(self):
-        self.select_board()
-        for i in range(0, 128):
-            self.do_cmd(i, 0, 0, 0)
+    def _send_frame(self):
+        if self.frame_writer:
+            self.ser.send_frame(self.pixels.reshape(-1, 3), self.size, self.write_page, self.brightness)
+            return
+        # Only send the voxels that differ from what is already on the page
+        if not writer_sync(self.ser):
+            # Something was dropped, so the hardware state is unknown.  A
+            # lost flip leaves its page pointers behind ours, so set them
+            # first, then send the frame in full.
+            self.shadow = [None, None]
+            self.select_board()
+            self.do_cmd(0x80, 0, self.display_page, self.write_page)
+            if self.brightness is not None:
+                self.set_brightness(self.brightness)
+        rgb = self.pixels.reshape(-1, 3)
+        previous = self.shadow[self.write_page]
+        if previous is None and numpy.count_nonzero(rgb.any(axis=1)) * 2 < len(rgb):
+            # Mostly dark frame, a broadcast clear is cheaper than a full frame
+            self.cmd_buffer.append(CLEAR_COMMANDS)
+            previous = self.encoder.zero
+        stream = self.encoder.encode(rgb, previous)
+        if len(stream) > 0:
+            self.cmd_buffer.append(stream)
+            self.current_board = None
+        self.shadow[self.write_page] = rgb.copy()
 
     def _flip(self):
         self.select_board()
@@ -157,21 +494,78 @@ class Cube(object):
         self._flush_data()
 
     def single_buffer(self):
+        self.double_buffered = False
         self.write_page = self.display_page
         self._flip()
 
     def swap(self):
+        self.double_buffered = True
+        self._send_frame()
         self.display_page = self.write_page
         self.write_page = 1 - self.write_page
         self._flip()
 
-    def set_pixel(self, xyz, rgb):
-        (r, g, b) = cubehelper.color_to_int(rgb)
-        (board, offset) = self.mapfn(xyz)
-        if board != self.current_board:
-            self.select_board(board)
-        self.do_cmd(offset, r, g, b)
-
     def render(self):
-        self.bus_reset()
+        # When double buffered the frame goes out together with the flip
+        if not self.double_buffered:
+            self._send_frame()
+            self.bus_reset()
+            self._flush_data()
+
+    def close(self):
         self._flush_data()
+        if hasattr(self.ser, 'close'):
+            self.ser.close()
+
+class MultiCube(cubehelper.PixelBuffer):
+    """Drives several physical cubes as one.
+
+    With the 'tile' layout, n*n*n cubes make up a virtual cube n times
+    the size, ordered x, then y, then z.  With 'mirror' every cube shows
+    the same image.  Each physical cube draws straight from its part of
+    the shared framebuffer, and is written from its own thread."""
+    def __init__(self, args, ports):
+        layout = getattr(args, 'layout', 'tile')
+        if layout == 'mirror':
+            n = 1
+        elif layout == 'tile':
+            n = int(round(len(ports) ** (1.0 / 3)))
+            if n ** 3 != len(ports):
+                raise Exception("Cannot tile %d cubes" % len(ports))
+        else:
+            raise Exception("Bad cube layout: '%s'" % layout)
+        sz = args.size
+        self.size = sz * n
+        self.pixels = numpy.zeros((self.size, self.size, self.size, 3), numpy.uint8)
+        self.cubes = []
+        for (i, port) in enumerate(ports):
+            sub_args = argparse.Namespace(port=port, size=sz,
+                    queue=max(getattr(args, 'queue', 0), 1), drop=getattr(args, 'drop', False))
+            cube = Cube(sub_args)
+            if layout == 'tile':
+                (x, y, z) = (i // (n * n), (i // n) % n, i % n)
+                cube.pixels = self.pixels[x*sz:(x+1)*sz, y*sz:(y+1)*sz, z*sz:(z+1)*sz]
+            else:
+                cube.pixels = self.pixels
+            self.cubes.append(cube)
+        self.color = all(cube.color for cube in self.cubes)
+
+    def set_brightness(self, rgb):
+        for cube in self.cubes:
+            cube.set_brightness(rgb)
+
+    def single_buffer(self):
+        for cube in self.cubes:
+            cube.single_buffer()
+
+    def swap(self):
+        for cube in self.cubes:
+            cube.swap()
+
+    def render(self):
+        for cube in self.cubes:
+            cube.render()
+
+    def close(self):
+        for cube in self.cubes:
+            cube.close()